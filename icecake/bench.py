@@ -0,0 +1,291 @@
+# -*- coding: utf8 -*-
+"""
+Benchmarks for icecake. This generates a synthetic site and times the things
+that make icecake feel fast or slow: cold and warm builds, editing a page
+while watching, parsing front matter, finding dependents, querying pages, and
+writing feeds. Front matter is also parsed with configparser, which icecake
+used before it had its own parser, for comparison.
+
+Results are plain JSON so they can be saved and compared against a baseline
+from an earlier run. Use it through `icecake bench`.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import codecs
+import json
+import os
+from os.path import exists, join
+import platform
+import random
+import shutil
+import time
+
+from . import cli
+
+__metaclass__ = type
+
+timer = getattr(time, 'perf_counter', time.time)
+
+words = ('cake ice cream sprinkles cone scoop waffle sundae vanilla chocolate '
+         'strawberry mint cherry fudge caramel sorbet gelato frozen sweet cold').split()
+
+code_sample = '''```python
+def scoop(flavor, count={count}):
+    """Serve some ice cream"""
+    return [flavor.upper() for _ in range(count)]
+```
+'''
+
+
+def sentence(rand, length=12):
+    return ' '.join(rand.choice(words) for _ in range(length)).capitalize() + '.'
+
+
+def random_bytes(rand, size):
+    """size random bytes from rand, made all at once (to_bytes is Python 3 only)"""
+    if size <= 0:
+        return b''
+    import binascii
+    return binascii.unhexlify('%0*x' % (size * 2, rand.getrandbits(size * 8)))
+
+
+def parse_with_configparser(text):
+    """Parse front matter the way icecake used to, for comparison"""
+    try:
+        import configparser
+    except ImportError:
+        import ConfigParser as configparser
+    parser = configparser.RawConfigParser()
+    text = '[Metadata]\n' + text
+    if hasattr(parser, 'read_string'):
+        parser.read_string(text)
+    else:
+        import io
+        parser.readfp(io.StringIO(text))
+    return dict(parser.items('Metadata'))
+
+
+def generate_site(root, pages=200, tags=20, layout_depth=2, code_blocks=1, static_files=20,
+                  static_size=4096, seed=0):
+    """
+    Create a synthetic site at root, starting from the starter site.
+
+    Keyword Arguments:
+    pages -- Number of markdown articles to generate.
+    tags -- Number of distinct tags; each article gets up to three of them.
+    layout_depth -- Number of layouts stacked on top of markdown.html, each
+            extending the one before it. Articles use the deepest one.
+    code_blocks -- Number of highlighted code blocks in each article.
+    static_files -- Number of extra static files.
+    static_size -- Size of each static file in bytes.
+    seed -- Seed for the random content, so runs are comparable.
+    """
+    rand = random.Random(seed)
+    cli.Site.initialize(root)
+
+    layout = 'markdown.html'
+    for depth in range(1, layout_depth + 1):
+        name = 'bench-%d.html' % depth
+        with codecs.open(join(root, 'layouts', name), encoding='utf-8', mode='w') as f:
+            f.write('{%% extends "%s" %%}\n'
+                    '{%% block content %%}<div class="depth-%d">{{ super() }}</div>{%% endblock %%}\n'
+                    % (layout, depth))
+        layout = name
+
+    for i in range(pages):
+        page_tags = sorted(set('tag-%d' % rand.randrange(max(tags, 1)) for _ in range(3)))
+        with codecs.open(join(root, 'content', 'articles', 'post-%05d.md' % i), encoding='utf-8', mode='w') as f:
+            f.write('title = %s\n' % sentence(rand, 4)[:-1])
+            f.write('date = %04d-%02d-%02d\n' % (2010 + i % 8, i % 12 + 1, i % 28 + 1))
+            f.write('tags = %s\n' % ' '.join(page_tags))
+            f.write('template = %s\n' % layout)
+            f.write('++++\n\n')
+            for block in range(max(code_blocks, 1)):
+                f.write(' '.join(sentence(rand) for _ in range(5)) + '\n\n')
+                if block < code_blocks:
+                    f.write(code_sample.format(count=i) + '\n')
+
+    assets = join(root, 'static', 'assets')
+    if static_files and not exists(assets):
+        os.makedirs(assets)
+    for i in range(static_files):
+        with open(join(assets, 'asset-%04d.bin' % i), 'wb') as f:
+            f.write(random_bytes(rand, static_size))
+
+
+class Benchmark:
+    """
+    Times each step against a generated site. Every step runs repeat times and
+    we keep all of the runs along with the min and median, in seconds.
+    """
+
+    def __init__(self, root, repeat=3, jobs=1, markdown_engine=cli.MarkdownEngine.name):
+        self.root = root
+        self.repeat = repeat
+        self.jobs = jobs
+        self.markdown_engine = markdown_engine
+
+    def site(self):
+        return cli.Site(self.root, markdown_engine=self.markdown_engine)
+
+    def measure(self, step, setup=None):
+        runs = []
+        for _ in range(self.repeat):
+            state = setup() if setup is not None else None
+            start = timer()
+            step(state)
+            runs.append(timer() - start)
+        runs.sort()
+        return {
+            'runs': runs,
+            'min': runs[0],
+            'median': runs[len(runs) // 2],
+        }
+
+    def cold_build(self):
+        def setup():
+            shutil.rmtree(join(self.root, '.icecake-cache'), ignore_errors=True)
+            shutil.rmtree(join(self.root, 'output'), ignore_errors=True)
+        return self.measure(lambda state: self.site().build(full=True, jobs=self.jobs), setup)
+
+    def warm_rebuild(self):
+        self.site().build(jobs=self.jobs)
+        return self.measure(lambda state: self.site().build(jobs=self.jobs))
+
+    def single_edit(self):
+        site = self.site()
+        site.build(jobs=self.jobs)
+        path = join('content', 'articles', 'post-00000.md')
+        edits = []
+
+        def setup():
+            edits.append(len(edits))
+            with codecs.open(join(self.root, path), encoding='utf-8', mode='a') as f:
+                f.write('\nEdit number %d.\n' % len(edits))
+        return self.measure(lambda state: site.apply_changes([path]), setup)
+
+    def parse_pages(self):
+        site = self.site()
+        return self.measure(lambda state: site.get_pages())
+
+    def front_matter_sources(self):
+        site = self.site()
+        sources = [cli.Page.split(site.cache.get(join('content', filepath)))[0] for filepath in sorted(site.pagedata)]
+        return [source for source in sources if source is not None]
+
+    def front_matter(self):
+        sources = self.front_matter_sources()
+        return self.measure(lambda state: [cli.parse_front_matter(text) for text in sources])
+
+    def front_matter_configparser(self):
+        sources = self.front_matter_sources()
+        return self.measure(lambda state: [parse_with_configparser(text) for text in sources])
+
+    def list_dependents(self):
+        site = self.site()
+        return self.measure(lambda state: site.list_dependents('basic.html'))
+
+    def pages_query(self):
+        site = self.site()
+
+        def setup():
+            # Start from a fresh index as a build would
+            site.index = None
+
+        def step(state):
+            site.pages(path='articles/', order='-date', limit=10)
+            site.pages(tag=site.tags()[0], order='title')
+            site.pages(order='date')
+        return self.measure(step, setup)
+
+    def feed(self):
+        site = self.site()
+        for page in site.pagedata.values():
+            page.get_content()
+
+        def setup():
+            site.feeds = {}
+        return self.measure(lambda state: site.atom('Bench', 'https://example.com/atom.xml', None,
+                                                    'https://example.com', 'icecake', path='articles/',
+                                                    order='-date'), setup)
+
+    steps = ['cold_build', 'warm_rebuild', 'single_edit', 'parse_pages', 'front_matter', 'front_matter_configparser',
+             'list_dependents', 'pages_query', 'feed']
+
+    def run(self):
+        results = {}
+        for step in self.steps:
+            results[step] = getattr(self, step)()
+        return results
+
+
+def run(root=None, repeat=3, jobs=1, markdown_engine=cli.MarkdownEngine.name, **params):
+    """
+    Generate a site with params (see generate_site) and benchmark it. The site
+    goes in a temporary folder unless root is given. Returns the report.
+    """
+    import tempfile
+    temp = None
+    if root is None:
+        temp = tempfile.mkdtemp(prefix='icecake-bench-')
+        root = join(temp, 'site')
+    ui = cli.ui
+    # Builds report every file they write, which would drown out the results
+    cli.ui = lambda *args, **kwargs: None
+    try:
+        generate_site(root, **params)
+        results = Benchmark(root, repeat=repeat, jobs=jobs, markdown_engine=markdown_engine).run()
+    finally:
+        cli.ui = ui
+        if temp is not None:
+            shutil.rmtree(temp, ignore_errors=True)
+    options = dict(params, repeat=repeat, jobs=jobs, markdown_engine=markdown_engine)
+    return {
+        'version': 1,
+        'python': platform.python_version(),
+        'params': options,
+        'results': results,
+    }
+
+
+def compare(report, baseline, threshold=0.1):
+    """
+    Compare the median of each step with a baseline report. Returns a list of
+    (step, baseline, current, ratio, regressed) tuples; a step regressed if
+    it is more than threshold (a fraction) slower than the baseline.
+    """
+    comparison = []
+    for step in Benchmark.steps:
+        if step not in report['results'] or step not in baseline.get('results', {}):
+            continue
+        before = baseline['results'][step]['median']
+        after = report['results'][step]['median']
+        ratio = after / before if before else float('inf')
+        comparison.append((step, before, after, ratio, ratio > 1 + threshold))
+    return comparison
+
+
+def format_report(report, comparison=None):
+    """Format a report (and optionally a comparison) as a table"""
+    lines = ['%-16s %12s %12s' % ('step', 'min (ms)', 'median (ms)')]
+    for step in Benchmark.steps:
+        if step in report['results']:
+            result = report['results'][step]
+            lines.append('%-16s %12.2f %12.2f' % (step, result['min'] * 1000, result['median'] * 1000))
+    if comparison:
+        lines.append('')
+        lines.append('%-16s %12s %12s %8s' % ('step', 'baseline', 'current', 'change'))
+        for step, before, after, ratio, regressed in comparison:
+            lines.append('%-16s %12.2f %12.2f %+7.1f%%%s' % (step, before * 1000, after * 1000, (ratio - 1) * 100,
+                                                           '  REGRESSION' if regressed else ''))
+    return '\n'.join(lines)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
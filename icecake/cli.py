@@ -12,38 +12,41 @@ it sports the following features:
 - Automatically rebuilds when you edit things
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
+from bisect import bisect_left
 import codecs
+from collections import OrderedDict
+import fnmatch
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import hashlib
+import heapq
+import json
 import logging
+import mimetypes
 import os
 import platform
 import posixpath
+import re
+import threading
 from os.path import abspath, basename, dirname, exists, isdir, isfile, join, normpath, relpath, splitext
-from multiprocessing import Process
 import time
 import shutil
+import sys
 
 
 import click
 import jinja2
-import jinja2.meta
-import markdown
-from dateutil.parser import parse as dateparse
-from werkzeug.contrib.atom import AtomFeed
-import watchdog.observers
-import watchdog.events
+# markdown, dateutil, watchdog, multiprocessing, and the server modules are
+# imported where they're used, so commands that don't need them start fast
 
 
 from .templates import templates
 from .livejs import livejs
+from .livereload import livereload
 if platform.python_version_tuple()[0] == '2':
-    import ConfigParser as configparser
-    import io
-    from SimpleHTTPServer import SimpleHTTPRequestHandler
-    from SocketServer import TCPServer
+    from urllib import unquote
 else:
-    import configparser
-    from http.server import SimpleHTTPRequestHandler
-    from socketserver import TCPServer
+    from urllib.parse import unquote
 
 
 __metaclass__ = type
@@ -56,65 +59,524 @@ def ui(*args, **kwargs):
     pass
 
 
+timer = getattr(time, 'perf_counter', time.time)
+
+
 def ls_relative(list_path):
     """
     List files relative to the specified path
     """
-    found = []
-    # Guard against dir doesn't exist
-    if not isdir(list_path):
-        return found
-    for path, dirs, files in os.walk(list_path):
-        for file in files:
-            filepath = join(path, file)
-            found.append(relpath(filepath, list_path))
+    found = list(scan(list_path))
     found.sort()  # Make sure the sort order is deterministic
     return found
 
 
+def scan(root, folder='', ignore=None):
+    """
+    Yield the files under root/folder, relative to root/folder, as we find
+    them. Files and folders matched by ignore (an IgnoreRules) are skipped;
+    the rules see paths relative to root. Like os.walk, we don't follow
+    symlinks to folders, so a link loop can't trap us. Uses scandir where we
+    have it so we don't need a stat call for each file.
+    """
+    top = join(root, folder)
+    if not isdir(top):
+        return
+    scandir = getattr(os, 'scandir', None)
+    pending = ['']
+    while pending:
+        current = pending.pop()
+        if scandir is not None:
+            entries = [(entry.name, entry.is_dir(), entry.is_symlink()) for entry in scandir(join(top, current))]
+        else:
+            entries = [(name, isdir(join(top, current, name)), os.path.islink(join(top, current, name)))
+                       for name in os.listdir(join(top, current))]
+        subfolders = []
+        for name, is_dir, is_link in sorted(entries):
+            if is_dir and is_link:
+                continue
+            path = join(current, name)
+            # We never go into ignored folders, so only the entry itself needs
+            # to be checked
+            if ignore is not None and ignore.matches(join(folder, path).replace(os.sep, '/'), name, is_dir):
+                continue
+            if is_dir:
+                subfolders.append(path)
+            else:
+                yield path
+        pending.extend(reversed(subfolders))
+
+
+class IgnoreRules:
+    """
+    Decides which files in a site we pretend aren't there, like version
+    control folders and editor swap files. Patterns use shell wildcards and
+    are read from .icecakeignore in the site root, one per line, in addition
+    to the defaults. A pattern without a slash matches a file or folder by
+    name anywhere; a pattern with a slash matches the path from the site
+    root. A trailing slash only matches folders. Lines starting with # are
+    comments.
+    """
+    defaults = ['.git/', '.hg/', '.svn/', '.icecake-cache/', '.DS_Store', 'Thumbs.db',
+                '*.swp', '*.swo', '*.swx', '*~', '.#*', '#*#', '4913', '.tmp-*']
+
+    def __init__(self, patterns=None):
+        # Patterns are compiled into one regular expression for each kind of
+        # rule, since we check every file we discover
+        rules = dict((key, []) for key in ('names', 'folder_names', 'paths', 'folder_paths'))
+        for pattern in self.defaults + list(patterns or []):
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            kind = 'paths' if '/' in pattern.strip('/') else 'names'
+            if pattern.endswith('/'):
+                kind = 'folder_' + kind
+            rules[kind].append(fnmatch.translate(pattern.strip('/')))
+        for kind, expressions in rules.items():
+            setattr(self, kind, re.compile('|'.join(expressions)).match if expressions else None)
+
+    @classmethod
+    def load(cls, root):
+        path = join(root, '.icecakeignore')
+        if not isfile(path):
+            return cls()
+        with codecs.open(path, encoding='utf-8') as f:
+            return cls(f.read().splitlines())
+
+    def matches(self, path, name, is_dir):
+        """Whether a rule matches this entry itself, ignoring its folders"""
+        if self.names is not None and self.names(name):
+            return True
+        if self.paths is not None and self.paths(path):
+            return True
+        if is_dir:
+            if self.folder_names is not None and self.folder_names(name):
+                return True
+            if self.folder_paths is not None and self.folder_paths(path):
+                return True
+        return False
+
+    def ignores(self, path, is_dir=False):
+        """Whether to skip path, which is relative to the site root"""
+        parts = path.replace(os.sep, '/').split('/')
+        # A file is also ignored if any folder it's in is ignored
+        for i, name in enumerate(parts):
+            if self.matches('/'.join(parts[:i + 1]), name, is_dir or i < len(parts) - 1):
+                return True
+        return False
+
+
+def digest(content):
+    """
+    Hash a string so we can tell whether a source or output file has changed
+    since the last build
+    """
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def file_digest(path):
+    """
+    Hash a file on disk, or return None if it does not exist
+    """
+    if not isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return digest(f.read())
+
+
+def make_folder(folder):
+    if not isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # Another thread may have created it in the meantime
+            if not isdir(folder):
+                raise
+
+
+def write_atomic(path, data, mode=None):
+    """
+    Write bytes to a temporary file next to path and move it into place, so
+    readers (and other processes) never see a partially written file. The
+    folder must exist. Temporary files are only readable by us, so pass mode
+    for files other people need to read.
+    """
+    import tempfile
+    fd, temp = tempfile.mkstemp(dir=dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(temp, mode)
+        getattr(os, 'replace', os.rename)(temp, path)
+    except BaseException:
+        if exists(temp):
+            os.remove(temp)
+        raise
+
+
+def copy_file(source, target, link=False):
+    """
+    Copy a file and its modification time. If link is True we try to hard link
+    the file instead. Otherwise we use copy_file_range where it's available,
+    which copies inside the kernel (and shares blocks on filesystems that
+    support reflinks), and fall back to a regular copy.
+
+    The copy is written next to target and moved into place, so if target is
+    a hard link to something (such as the source, after a build with link)
+    that file is left alone.
+    """
+    try:
+        src = os.stat(source)
+        dst = os.stat(target)
+        if (src.st_dev, src.st_ino) == (dst.st_dev, dst.st_ino):
+            return  # target is already a link to source
+    except OSError:
+        pass
+    if link:
+        try:
+            if exists(target):
+                os.remove(target)
+            os.link(source, target)
+            return
+        except (AttributeError, OSError):
+            logging.debug('Unable to link %s; copying instead', source)
+    import tempfile
+    fd, temp = tempfile.mkstemp(dir=dirname(target), prefix='.tmp-')
+    try:
+        copied = False
+        copy_range = getattr(os, 'copy_file_range', None)
+        with os.fdopen(fd, 'wb') as dst:
+            if copy_range is not None:
+                try:
+                    with open(source, 'rb') as src:
+                        remaining = os.fstat(src.fileno()).st_size
+                        while remaining > 0:
+                            count = copy_range(src.fileno(), dst.fileno(), remaining)
+                            if count == 0:
+                                break
+                            remaining -= count
+                    copied = True
+                except OSError:
+                    logging.debug('copy_file_range failed for %s; copying instead', source)
+        if copied:
+            shutil.copystat(source, temp)
+        else:
+            shutil.copy2(source, temp)
+        getattr(os, 'replace', os.rename)(temp, target)
+    except BaseException:
+        if exists(temp):
+            os.remove(temp)
+        raise
+
+
+def is_same_file(source, target, checksum=False):
+    """
+    Check whether target is already an up-to-date copy of source. We compare
+    size and modification time, or the file hashes if checksum is True.
+    """
+    try:
+        src = os.stat(source)
+        dst = os.stat(target)
+    except OSError:
+        return False
+    if (src.st_dev, src.st_ino) == (dst.st_dev, dst.st_ino):
+        return True  # This is a hard link
+    if src.st_size != dst.st_size:
+        return False
+    if checksum:
+        return file_digest(source) == file_digest(target)
+    return int(src.st_mtime) == int(dst.st_mtime)
+
+
+class NullSpan:
+    """Stands in for a profiler measurement when we're not profiling"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Profiler:
+    """
+    Records where a build spends its time. Each measurement belongs to one of
+    the phases below and optionally to a page and a template. Phases nest (a
+    Jinja render may convert markdown for a feed, which runs Pygments), so we
+    count each measurement's own time without the phases nested inside it.
+    That way the phase totals add up to the time we measured.
+    """
+    phases = ['cache warm', 'metadata parse', 'markdown', 'pygments', 'jinja render', 'disk write', 'static copy',
+              'compress']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.patched = []
+        self.reset()
+
+    def reset(self):
+        self.origin = timer()
+        self.totals = dict((phase, [0.0, 0]) for phase in self.phases)
+        self.pages = {}
+        self.templates = {}
+        self.events = []
+
+    @contextmanager
+    def measure(self, phase, page=None, template=None):
+        stack = self.local.__dict__.setdefault('stack', [])
+        if page is None and stack:
+            # Nested phases like pygments belong to the page being converted
+            page = stack[-1][1]
+        frame = [0.0, page]
+        stack.append(frame)
+        start = timer()
+        try:
+            yield
+        finally:
+            end = timer()
+            stack.pop()
+            if stack:
+                stack[-1][0] += end - start
+            self.record(phase, start, end, end - start - frame[0], page, template)
+
+    def record(self, phase, start, end, own, page, template):
+        with self.lock:
+            total = self.totals.setdefault(phase, [0.0, 0])
+            total[0] += own
+            total[1] += 1
+            if page is not None:
+                total = self.pages.setdefault(page, [0.0, 0])
+                total[0] += own
+                total[1] += 1
+            if template is not None:
+                total = self.templates.setdefault(template, [0.0, 0])
+                total[0] += own
+                total[1] += 1
+            args = dict((key, value) for key, value in (('page', page), ('template', template)) if value)
+            self.events.append({
+                'name': page or template or phase,
+                'cat': phase,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1000000,
+                'dur': (end - start) * 1000000,
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args,
+            })
+
+    def wrap(self, module, name):
+        original = getattr(module, name)
+        profiler = self
+
+        def measured(*args, **kwargs):
+            with profiler.measure('pygments'):
+                return original(*args, **kwargs)
+        setattr(module, name, measured)
+        self.patched.append((module, name, original))
+
+    def install(self):
+        """
+        Measure Pygments until uninstall. Code blocks that aren't in the
+        HighlightCache are highlighted with pygments.highlight, so that's the
+        one we wrap.
+        """
+        try:
+            import pygments
+            self.wrap(pygments, 'highlight')
+        except ImportError:
+            pass
+
+    def uninstall(self):
+        while self.patched:
+            module, name, original = self.patched.pop()
+            setattr(module, name, original)
+
+    def report(self):
+        """Summarize the measurements as a dict that can be saved as JSON"""
+        def table(totals):
+            return [{'name': name, 'seconds': seconds, 'calls': calls}
+                    for name, (seconds, calls) in sorted(totals.items(), key=lambda item: -item[1][0])]
+        return {
+            'wall': timer() - self.origin,
+            'phases': table(self.totals),
+            'pages': table(self.pages),
+            'templates': table(self.templates),
+        }
+
+    def trace(self):
+        """The measurements in Chrome's trace event format"""
+        return {'traceEvents': sorted(self.events, key=lambda event: event['ts']), 'displayTimeUnit': 'ms'}
+
+    def format_report(self, limit=10):
+        """Format the phases and the slowest pages and templates as tables"""
+        report = self.report()
+        lines = []
+        for title, rows in (('phase', report['phases']),
+                            ('slowest pages', report['pages'][:limit]),
+                            ('slowest templates', report['templates'][:limit])):
+            if lines:
+                lines.append('')
+            lines.append('%-40s %8s %12s' % (title, 'calls', 'time (ms)'))
+            for row in rows:
+                lines.append('%-40s %8d %12.2f' % (row['name'], row['calls'], row['seconds'] * 1000))
+        lines.append('')
+        lines.append('%-40s %8s %12.2f' % ('wall time', '', report['wall'] * 1000))
+        return '\n'.join(lines)
+
+
+def stat_signature(stat):
+    """
+    Summarize a stat result so we can tell whether a file changed without
+    reading it
+    """
+    return stat.st_size, getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1000000000)), stat.st_ino
+
+
 class ContentCache:
-    def __init__(self, root):
+    """
+    Keeps the source of content and layout files in memory. Templates (layouts
+    and content pages other than markdown) are pinned because Jinja and the
+    dependency graph use them all the time. Markdown page bodies are kept in
+    least recently used order up to budget characters; evicted bodies are read
+    from disk again when someone asks for them.
+
+    We remember the size, mtime, and inode of each file so we can tell whether
+    it changed without reading it, and a hash of evicted files so we can tell
+    whether one that was touched really changed.
+    """
+    budget = 64 * 1024 * 1024
+
+    def __init__(self, root, ignore=None, budget=None):
         self.root = root
-        self.files = {}
+        self.ignore = ignore
+        if budget is not None:
+            self.budget = budget
+        self.files = {}  # filename -> content, or None once evicted
+        self.signatures = {}
+        self.digests = {}  # evicted filename -> hash of its content
+        self.recent = OrderedDict()  # unpinned filename -> size, oldest first
+        self.used = 0
         self.pages = {}
         self.templates = {}
         self.rebuild_index = {}
 
+    def load(self, filename):
+        """
+        Read a file from disk. Returns its content and signature, or (None,
+        None) if there is no such file.
+        """
+        file = join(self.root, filename)
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None, None
+        if not isfile(file):
+            return None, None
+        with open(file, 'rb') as f:
+            data = f.read()
+        return data.decode('utf-8'), stat_signature(stat)
+
     def peek(self, filename):
         """
         peek when you want to get fresh data from disk but NOT store it in the cache
         """
-        file = join(self.root, filename)
-        if isfile(file):
-            content = codecs.open(file, encoding='utf-8').read()
-            return content
-        return None
+        return self.load(filename)[0]
 
     def read(self, filename):
         """
         read when you want to get fresh data from disk and store it in the cache
         """
-        content = self.peek(filename)
+        content, signature = self.load(filename)
         if content is not None:
-            self.set(filename, content)
+            self.set(filename, content, signature)
         return content
 
-    def set(self, filename, content):
+    def is_pinned(self, filename):
+        if filename.startswith('content'):
+            # Markdown files are not templates so let's skip those
+            return splitext(filename)[1] != '.md'
+        return filename.startswith('layouts')
+
+    def set(self, filename, content, signature=None):
         if filename.startswith('content'):
             # Markdown files are not templates so let's skip those
             if splitext(filename)[1] != '.md':
                 self.templates[relpath(filename, 'content')] = content
         if filename.startswith('layouts'):
             self.templates[relpath(filename, 'layouts')] = content
+        self.forget(filename)
         self.files[filename] = content
+        if signature is not None:
+            self.signatures[filename] = signature
+        if not self.is_pinned(filename):
+            self.recent[filename] = len(content)
+            self.used += len(content)
+            self.evict()
+
+    def forget(self, filename):
+        """Stop tracking the content we had for filename"""
+        self.used -= self.recent.pop(filename, 0)
+        self.signatures.pop(filename, None)
+        self.digests.pop(filename, None)
+
+    def evict(self):
+        # Keep the newest entry even if it's bigger than the whole budget
+        while self.used > self.budget and len(self.recent) > 1:
+            filename, size = self.recent.popitem(last=False)
+            logging.debug('Evicting %s from the content cache', filename)
+            self.used -= size
+            self.digests[filename] = digest(self.files[filename])
+            self.files[filename] = None
 
     def get(self, filename):
-        if filename in self.files:
-            return self.files[filename]
-        return None
+        if filename not in self.files:
+            return None
+        content = self.files[filename]
+        if content is None:
+            # This was evicted, so go back to the disk
+            return self.read(filename)
+        if filename in self.recent:
+            self.recent[filename] = self.recent.pop(filename)
+        return content
+
+    def is_fresh(self, filename):
+        """
+        Whether filename is unchanged on disk since we read it, going by its
+        size, mtime, and inode
+        """
+        if filename not in self.signatures:
+            return False
+        try:
+            return stat_signature(os.stat(join(self.root, filename))) == self.signatures[filename]
+        except OSError:
+            return False
+
+    def refresh(self, filename):
+        """
+        Read filename again if it looks different on disk. Returns whether its
+        content changed.
+        """
+        if self.is_fresh(filename):
+            return False
+        old = self.files.get(filename)
+        previous = self.digests.get(filename)
+        content = self.read(filename)
+        if old is None and previous is not None:
+            # This was evicted, so compare hashes instead
+            return content is None or digest(content) != previous
+        return old is None or content != old
 
     def delete(self, filename):
-        del(self.files[filename])
+        self.forget(filename)
+        self.files.pop(filename, None)
+        if filename.startswith('content'):
+            self.templates.pop(relpath(filename, 'content'), None)
+        if filename.startswith('layouts'):
+            self.templates.pop(relpath(filename, 'layouts'), None)
 
     def move(self, old, new):
         if old not in self.files:
@@ -122,10 +584,684 @@ class ContentCache:
         self.set(new, self.get(old))
         self.delete(old)
 
-    def warm(self):
-        for path in ['content', 'layouts']:
-            for file in ls_relative(join(self.root, path)):
-                self.read(join(path, file))
+    def warm(self, threads=8, loaded=None):
+        """
+        Read everything under content and layouts. Files are read by a pool of
+        threads while we're still finding the rest, which helps a lot when
+        the disk (or network filesystem) is slow. loaded is called with each
+        filename and its content as it comes in, so the content can be used
+        before it might be evicted.
+        """
+        def discover():
+            for path in ['content', 'layouts']:
+                for file in scan(self.root, path, self.ignore):
+                    yield join(path, file)
+
+        def read(filename):
+            return filename, self.load(filename)
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            for filename, (content, signature) in pool.imap_unordered(read, discover(), 64):
+                if content is not None:
+                    self.set(filename, content, signature)
+                    if loaded is not None:
+                        loaded(filename, content)
+        finally:
+            pool.close()
+            pool.join()
+
+
+class CacheLoader(jinja2.BaseLoader):
+    """
+    Loads templates from the content cache. Jinja checks the uptodate callback
+    before reusing a compiled template, so a template is only compiled again
+    after the cache has been given new source for it.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def get_source(self, environment, template):
+        source = self.cache.templates.get(template)
+        if source is None:
+            raise jinja2.TemplateNotFound(template)
+        return source, None, lambda: self.cache.templates.get(template) is source
+
+    def list_templates(self):
+        return sorted(self.cache.templates)
+
+
+class MarkdownCache:
+    """
+    A cache of markdown converted to HTML, keyed by a hash of the markdown
+    source and the settings used to convert it. The most recently used entries
+    are kept in memory. If a path is set, entries are also stored on disk so
+    they survive between builds; prune() keeps the disk cache under max_bytes
+    by removing the least recently used entries.
+    """
+
+    def __init__(self, path=None, size=4096, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.size = size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+
+    def key(self, body, engine):
+        return digest(json.dumps([engine.name, engine.version(), engine.extensions,
+                                  engine.options, body], sort_keys=True, default=repr))
+
+    def _disk_path(self, key):
+        return join(self.path, key[:2], key + '.html')
+
+    def get(self, key):
+        if key in self.entries:
+            # Move this entry to the end so it's evicted last
+            value = self.entries.pop(key)
+            self.entries[key] = value
+            return value
+        if self.path is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read().decode('utf-8')
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        if self.path is not None:
+            path = self._disk_path(key)
+            make_folder(dirname(path))
+            write_atomic(path, value.encode('utf-8'))
+
+    def _remember(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries = OrderedDict()
+        if self.path is not None and isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def prune(self):
+        """
+        Remove the least recently used entries from the disk cache until it is
+        smaller than max_bytes
+        """
+        if self.path is None or not isdir(self.path):
+            return
+        files = []
+        total = 0
+        for file in ls_relative(self.path):
+            stat = os.stat(join(self.path, file))
+            files.append((stat.st_mtime, stat.st_size, file))
+            total += stat.st_size
+        files.sort()
+        for mtime, size, file in files:
+            if total <= self.max_bytes:
+                break
+            os.remove(join(self.path, file))
+            total -= size
+
+
+class HighlightCache(MarkdownCache):
+    """
+    A cache of code blocks highlighted by Pygments, keyed by a hash of the
+    code, the lexer, and the formatter with their options. Sites tend to
+    repeat the same snippets across many pages, and a page whose prose
+    changed keeps its code blocks, so most blocks are only highlighted once.
+    Like MarkdownCache, entries can be kept on disk between builds.
+    """
+
+    def __init__(self, path=None, size=16384, max_bytes=256 * 1024 * 1024):
+        MarkdownCache.__init__(self, path, size, max_bytes)
+
+    def key(self, code, lexer, formatter):
+        import pygments
+        return digest(json.dumps([pygments.__version__, type(lexer).__name__, lexer.options,
+                                  type(formatter).__name__, formatter.options, code],
+                                 sort_keys=True, default=repr))
+
+    def highlight(self, code, lexer, formatter):
+        key = self.key(code, lexer, formatter)
+        html = self.get(key)
+        if html is None:
+            import pygments
+            html = pygments.highlight(code, lexer, formatter)
+            self.set(key, html)
+        return html
+
+
+lexers = {}
+formatters = {}
+highlighting = threading.local()  # The HighlightCache for the markdown being converted
+highlighter_lock = threading.Lock()
+highlighter_users = [0, None]  # Conversions in progress, and codehilite's own functions
+
+
+def get_lexer(name, **options):
+    """
+    Get a Pygments lexer by name. Lexers (and formatters, below) don't change
+    once they're made, so we reuse one per name and options.
+    """
+    key = (name, json.dumps(options, sort_keys=True, default=repr))
+    if key not in lexers:
+        import pygments.lexers
+        lexers[key] = pygments.lexers.get_lexer_by_name(name, **options)
+    return lexers[key]
+
+
+def get_formatter(name, **options):
+    key = (name, json.dumps(options, sort_keys=True, default=repr))
+    if key not in formatters:
+        import pygments.formatters
+        formatters[key] = pygments.formatters.get_formatter_by_name(name, **options)
+    return formatters[key]
+
+
+def highlight(code, lexer, formatter):
+    """
+    Stands in for pygments.highlight in codehilite, using the HighlightCache
+    of the conversion in progress if there is one
+    """
+    cache = getattr(highlighting, 'cache', None)
+    if cache is None:
+        import pygments
+        return pygments.highlight(code, lexer, formatter)
+    return cache.highlight(code, lexer, formatter)
+
+
+@contextmanager
+def installed_highlighter():
+    """
+    Have codehilite go through highlight, get_lexer, and get_formatter while
+    we convert markdown. It imports the Pygments functions as its own names,
+    so that's where we replace them; whatever was there is put back when the
+    last conversion (on any thread) finishes, so codehilite is left alone for
+    everyone else.
+    """
+    import markdown.extensions.codehilite as codehilite
+    with highlighter_lock:
+        if highlighter_users[0] == 0:
+            highlighter_users[1] = (codehilite.highlight, codehilite.get_lexer_by_name,
+                                    codehilite.get_formatter_by_name)
+            codehilite.highlight = highlight
+            codehilite.get_lexer_by_name = get_lexer
+            codehilite.get_formatter_by_name = get_formatter
+        highlighter_users[0] += 1
+    try:
+        yield
+    finally:
+        with highlighter_lock:
+            highlighter_users[0] -= 1
+            if highlighter_users[0] == 0:
+                (codehilite.highlight, codehilite.get_lexer_by_name,
+                 codehilite.get_formatter_by_name) = highlighter_users[1]
+                highlighter_users[1] = None
+
+
+def pygments_version():
+    try:
+        import pygments
+    except ImportError:
+        return ''
+    return pygments.__version__
+
+
+class MarkdownEngine:
+    """
+    Converts markdown to HTML using Python-Markdown with the site's extensions.
+    Loading extensions and setting up codehilite takes longer than converting
+    a typical page, so we keep one converter per thread and reset it between
+    documents instead of creating a new one each time.
+    """
+    name = 'markdown'
+
+    def __init__(self, extensions, options, highlight_cache=None):
+        self.extensions = extensions
+        self.options = options
+        self.highlight_cache = highlight_cache
+        self.local = threading.local()
+
+    def version(self):
+        """
+        The versions of everything that affects our output, so caches keyed
+        on it are dropped after an upgrade
+        """
+        import markdown
+        version = getattr(markdown, '__version__', getattr(markdown, 'version', ''))
+        if self.highlights():
+            version += ' pygments ' + pygments_version()
+        return version
+
+    def highlights(self):
+        """Whether code blocks are highlighted with Pygments"""
+        return any('codehilite' in str(extension) for extension in self.extensions)
+
+    def convert(self, text):
+        converter = getattr(self.local, 'converter', None)
+        if converter is None:
+            import markdown
+            converter = markdown.Markdown(extensions=self.extensions,
+                                          extension_configs=self.options)
+            self.local.converter = converter
+        converter.reset()
+        if not self.highlights():
+            return converter.convert(text)
+        highlighting.cache = self.highlight_cache
+        try:
+            with installed_highlighter():
+                return converter.convert(text)
+        finally:
+            highlighting.cache = None
+
+
+class CommonMarkEngine(MarkdownEngine):
+    """
+    Converts markdown using markdown-it-py in CommonMark mode, which is faster
+    than Python-Markdown but does not support Python-Markdown extensions.
+    Fenced code blocks with a language are highlighted with Pygments inside
+    <pre class="codehilite"> so the codehilite stylesheet still applies.
+    markdown-it-py must be installed.
+    """
+    name = 'commonmark'
+
+    def version(self):
+        try:
+            import markdown_it
+        except ImportError:
+            # convert() explains what's missing
+            return ''
+        return markdown_it.__version__ + ' pygments ' + pygments_version()
+
+    def convert(self, text):
+        converter = getattr(self.local, 'converter', None)
+        if converter is None:
+            try:
+                from markdown_it import MarkdownIt
+            except ImportError:
+                raise RuntimeError("The commonmark engine requires markdown-it-py; "
+                                   "install it with `pip install markdown-it-py`")
+            converter = MarkdownIt('commonmark', {'highlight': self.highlight})
+            self.local.converter = converter
+        return converter.render(text)
+
+    def highlight(self, code, lang, attrs):
+        if not lang:
+            return None
+        import pygments.util
+        try:
+            lexer = get_lexer(lang)
+        except pygments.util.ClassNotFound:
+            return None
+        formatter = get_formatter('html', nowrap=True)
+        if self.highlight_cache is not None:
+            html = self.highlight_cache.highlight(code, lexer, formatter)
+        else:
+            import pygments
+            html = pygments.highlight(code, lexer, formatter)
+        # markdown-it only uses our markup as-is if it starts with <pre>
+        return '<pre class="codehilite"><code>%s</code></pre>' % html
+
+
+markdown_engines = {
+    MarkdownEngine.name: MarkdownEngine,
+    CommonMarkEngine.name: CommonMarkEngine,
+}
+
+
+class BuildManifest:
+    """
+    The build manifest remembers what went into each page the last time it was
+    built: a hash of the source file, of each template it used, and of any
+    site-wide data it referenced, plus a hash of the output it produced. On the
+    next build we compare against it and only render pages that changed.
+    """
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.options = None
+        self.pages = {}
+
+    def reset(self):
+        self.options = None
+        self.pages = {}
+
+    def load(self):
+        self.reset()
+        if not isfile(self.path):
+            return
+        try:
+            with codecs.open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except ValueError:
+            logging.warning("Ignoring unreadable build manifest %s", self.path)
+            return
+        if data.get('version') != self.version:
+            return
+        self.options = data.get('options')
+        self.pages = data.get('pages', {})
+
+    def save(self):
+        manifest_dir = dirname(self.path)
+        if not isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        data = {
+            'version': self.version,
+            'options': self.options,
+            'pages': self.pages,
+        }
+        with codecs.open(self.path, encoding='utf-8', mode='w') as f:
+            f.write(json.dumps(data, indent=1, sort_keys=True))
+
+    def record(self, filepath, inputs, target, output):
+        self.pages[filepath] = {
+            'inputs': inputs,
+            'target': target,
+            'output': output,
+        }
+
+    def forget(self, filepath):
+        self.pages.pop(filepath, None)
+
+    def is_fresh(self, filepath, inputs, target, output_path):
+        """
+        A page is fresh if none of its inputs changed and the file it produced
+        is still in the output folder, untouched.
+        """
+        entry = self.pages.get(filepath)
+        if entry is None:
+            return False
+        if entry['inputs'] != inputs or entry['target'] != target:
+            return False
+        return file_digest(output_path) == entry['output']
+
+
+class DependencyGraph:
+    """
+    The dependency graph tracks which templates reference which other templates
+    (via extends, include, or import) and which template each page is rendered
+    with. Each template is parsed once when it is added or changed, so finding
+    the pages affected by a change doesn't require parsing anything.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.references = {}  # template -> templates it references
+        self.referrers = {}   # template -> templates that reference it
+        self.variables = {}   # template -> variables it expects from outside
+        self.digests = {}     # template -> hash of its source
+        self.layouts = {}     # page filepath -> template used to render it
+        self.users = {}       # template -> pages rendered with it
+        self.closures = {}
+
+    def update_template(self, name, source):
+        try:
+            import jinja2.meta
+            ast = self.environment.parse(source)
+            references = set(ref for ref in jinja2.meta.find_referenced_templates(ast) if ref is not None)
+            variables = jinja2.meta.find_undeclared_variables(ast)
+        except jinja2.TemplateSyntaxError as e:
+            # We'll hear about this again when something tries to render it
+            logging.warning("Unable to parse template %s: %s", name, e)
+            references = set()
+            variables = set()
+        self.remove_template(name)
+        self.references[name] = references
+        self.variables[name] = variables
+        self.digests[name] = digest(source)
+        for ref in references:
+            self.referrers.setdefault(ref, set()).add(name)
+
+    def remove_template(self, name):
+        for ref in self.references.pop(name, ()):
+            self.referrers[ref].discard(name)
+        self.variables.pop(name, None)
+        self.digests.pop(name, None)
+        self.closures = {}
+
+    def update_page(self, filepath, template):
+        self.remove_page(filepath)
+        self.layouts[filepath] = template
+        self.users.setdefault(template, set()).add(filepath)
+
+    def remove_page(self, filepath):
+        template = self.layouts.pop(filepath, None)
+        if template is not None:
+            self.users[template].discard(filepath)
+
+    def list_templates(self, name):
+        """
+        List the templates used to render the named template, following
+        extends, include, and import. Returns a dict of template name to hash
+        and the set of variables referenced by any of them.
+        """
+        if name not in self.closures:
+            found = {}
+            variables = set()
+            pending = [name]
+            while pending:
+                current = pending.pop()
+                if current in found:
+                    continue
+                found[current] = self.digests.get(current)
+                variables.update(self.variables.get(current, ()))
+                pending.extend(self.references.get(current, ()))
+            self.closures[name] = (found, variables)
+        return self.closures[name]
+
+    def list_dependents(self, name):
+        """
+        List the pages that need to be rendered again when the named template
+        changes, following referrers through any number of templates. A page
+        does not depend on itself.
+        """
+        seen = set()
+        pending = [name]
+        pages = set()
+        while pending:
+            current = pending.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            pages.update(self.users.get(current, ()))
+            pending.extend(self.referrers.get(current, ()))
+        pages.discard(name)
+        return sorted(pages)
+
+
+iso_date = re.compile(r'(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?'
+                      r'\s*(Z|[+-]\d\d:?\d\d)?$')
+parsed_dates = {}  # Date strings we've already parsed, since many pages share one
+
+
+def parse_date(text):
+    """
+    Parse a date from page metadata into a timezone-aware datetime. Dates
+    without a timezone are taken to be UTC. ISO 8601 dates (which is what
+    most pages use) are parsed directly; anything else goes to dateutil.
+    Returns None if we can't make sense of the date.
+    """
+    if text in parsed_dates:
+        return parsed_dates[text]
+    from dateutil.tz import tzoffset, tzutc
+    match = iso_date.match(text.strip())
+    try:
+        if match is not None:
+            year, month, day, hour, minute, second, fraction, zone = match.groups()
+            if zone is None or zone == 'Z':
+                tz = tzutc()
+            else:
+                sign = -1 if zone[0] == '-' else 1
+                zone = zone[1:].replace(':', '')
+                tz = tzoffset(None, sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60))
+            date = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+                            int(second or 0), int((fraction or '0').ljust(6, '0')), tz)
+        else:
+            from dateutil.parser import parse as dateparse
+            date = dateparse(text)
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=tzutc())
+    except (ValueError, OverflowError):
+        logging.warning("Can't parse date %r", text)
+        date = None
+    parsed_dates[text] = date
+    return date
+
+
+# Fields that sort by something other than their raw metadata value
+sort_fields = {'date': 'published'}
+
+
+def sort_key(field, reverse=False):
+    """
+    Make a sort key for a metadata field. Pages that don't have the field sort
+    after the pages that do, whichever direction we're sorting in. Dates sort
+    by the datetime we parsed, not by how they were written.
+    """
+    missing = (-1,) if reverse else (1,)
+    field = sort_fields.get(field, field)
+
+    def key(page):
+        value = getattr(page, field)
+        if value is None:
+            return missing
+        return (0, value)
+    return key
+
+
+class PageIndex:
+    """
+    Indexes over the pages of a site that answer site.pages() and site.tags()
+    without scanning every page. Paths are kept sorted so a path prefix is a
+    contiguous range, tags map to the pages that have them, and each sort
+    order is computed once when it is first used. Query results are memoized,
+    so build a new index whenever the set of pages changes.
+    """
+
+    def __init__(self, pages):
+        self.pagedata = pages
+        self.paths = sorted(pages)
+        self.tagged = {}
+        for path in self.paths:
+            for tag in pages[path].tags or ():
+                self.tagged.setdefault(tag, set()).add(path)
+        self.tags = sorted(self.tagged)
+        self.orders = {}
+        self.results = {}
+
+    def with_prefix(self, prefix):
+        start = bisect_left(self.paths, prefix)
+        end = start
+        while end < len(self.paths) and self.paths[end].startswith(prefix):
+            end += 1
+        return self.paths[start:end]
+
+    def ordered(self, order):
+        """
+        Get all the pages sorted by a field; prefix the field with - to
+        reverse the order. Pages that sort the same stay in path order.
+        """
+        if order not in self.orders:
+            reverse = order.startswith('-')
+            pages = [self.pagedata[path] for path in self.paths]
+            self.orders[order] = sorted(pages, key=sort_key(order.lstrip('-'), reverse), reverse=reverse)
+        return self.orders[order]
+
+    def query(self, path=None, tag=None, limit=None, order=None):
+        key = (path, tag, limit, order)
+        if key not in self.results:
+            self.results[key] = self._query(path, tag, limit, order)
+        return list(self.results[key])
+
+    def _query(self, path, tag, limit, order):
+        if limit is not None and limit <= 0:
+            limit = None
+        if path is None and tag is None:
+            paths = None
+        elif path is None:
+            paths = sorted(self.tagged.get(tag, ()))
+        else:
+            paths = self.with_prefix(path)
+            if tag is not None:
+                # Walk whichever of the two is smaller
+                tagged = self.tagged.get(tag, ())
+                if len(tagged) < len(paths):
+                    paths = sorted(item for item in tagged if item.startswith(path))
+                else:
+                    paths = [item for item in paths if item in tagged]
+
+        if order is None:
+            if paths is None:
+                paths = self.paths
+            return [self.pagedata[item] for item in paths[:limit]]
+
+        if paths is None or len(paths) * 8 > len(self.paths):
+            # Most pages match, so walk the presorted list and stop early
+            # once we have enough
+            matches = None if paths is None else set(paths)
+            items = []
+            for page in self.ordered(order):
+                if matches is None or page.filepath in matches:
+                    items.append(page)
+                    if limit is not None and len(items) == limit:
+                        break
+            return items
+
+        # Only a few pages match, so sorting them is cheaper
+        pages = [self.pagedata[item] for item in paths]
+        reverse = order.startswith('-')
+        key = sort_key(order.lstrip('-'), reverse)
+        if limit is None:
+            return sorted(pages, key=key, reverse=reverse)
+        if reverse:
+            return heapq.nlargest(limit, pages, key=key)
+        return heapq.nsmallest(limit, pages, key=key)
+
+
+front_matter_line = re.compile(r'(.*?)\s*[=:]\s*(.*)$')
+
+
+def parse_front_matter(text):
+    """
+    Parse front matter into a dict. This follows the rules configparser used
+    to apply to it, without the cost of building a parser for every page:
+
+    - Each line is key = value (or key: value). Keys are lowercased and both
+      sides are stripped.
+    - Lines starting with # or ; are comments.
+    - Indented lines continue the previous value, joined with a newline.
+    - A repeated key replaces the earlier value.
+
+    Unlike configparser, % is just a character in a value, and lines we don't
+    understand are logged and skipped instead of failing the page.
+    """
+    values = {}
+    key = None
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        if key is not None and line[0].isspace():
+            values[key] += '\n' + stripped
+            continue
+        match = front_matter_line.match(stripped)
+        if match is None or not match.group(1):
+            logging.warning("Can't parse metadata line %r", line)
+            key = None
+            continue
+        key = match.group(1).lower()
+        values[key] = match.group(2)
+    return values
 
 
 class Page:
@@ -161,12 +1297,31 @@ class Page:
         self.tags = None      # This is a list of tags, used to build links
         self.template = None  # This is the template we'll use to render the page
         self.title = None     # This is the title of the page
+        self.published = None  # This is the date parsed into a datetime
 
         # These are set when the page is rendered (step 3)
-        self.body = None      # This is the raw body of the page
+        self.source_digest = None  # This is a hash of the source file
+        self._body = None     # This is the raw body of the page; see body
         self.content = None   # This is the content string for markdown pages
         self.rendered = None  # This is the HTML content of the page
 
+    @property
+    def body(self):
+        """
+        The raw body of the page. Pages that belong to a site don't keep it
+        once they're parsed; it comes from the site's content cache when we
+        need it, so it counts against the cache's memory budget.
+        """
+        if self._body is None:
+            text = self.site.cache.get(join('content', self.filepath))
+            if text is not None:
+                return self.split(text)[1]
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+
     def _get_folder(self):
         return dirname(self.filepath)
 
@@ -216,27 +1371,31 @@ class Page:
         # XML where the filename is important.
         return normpath(join(self.folder, self.slug + self.ext))
 
+    def get_template_name(self):
+        """
+        Get the name of the template used to render this page. Markdown pages
+        use markdown.html unless they specify a template in their metadata.
+        Everything else is a template in its own right.
+        """
+        if self.ext in [".md", ".markdown"]:
+            if self.template is not None:
+                return self.template
+            return "markdown.html"
+        return self.filepath
+
     def parse_metadata(self, text):
         """
         Parse a metadata string into object properties tags, date, title, etc.
         """
         logging.debug("Parsing metadata %s", text)
-        text = "[Metadata]\n" + text
-        parser = configparser.ConfigParser()
-        if platform.python_version_tuple()[0] == '2':
-            parser.readfp(io.StringIO(text))
-        else:
-            parser.read_string(text)
+        self.set_metadata(parse_front_matter(text))
 
-        # This is super ugly because of 2/3 compat. There's probably a cleaner
-        # way to factor this code.
-        values = {}
-        for k, v in parser.items("Metadata"):
-            values[k] = v
+    def set_metadata(self, values):
+        """
+        Set tags, date, title, etc. from a dict of parsed front matter
+        """
         for key in self.metadata:
-            value = None
-            if key in values:
-                value = values[key]
+            value = values.get(key)
             if key == "tags":
                 if value is not None:
                     value = value.split(" ")
@@ -251,6 +1410,7 @@ class Page:
             if value is None and key in self.required:
                 logging.warning("Metadata '%s' not specified in %s", key,
                                 self.filepath)
+        self.published = parse_date(self.date) if self.date else None
         self.url = self._get_url()
         self.parsed = True
 
@@ -262,35 +1422,66 @@ class Page:
         for everything else. Customize this via the "template" metadata field.
         """
         logging.debug("Rendering %s" % self.filepath)
-        if self.ext in [".md", ".markdown"]:
-            self.content = markdown.markdown(self.body,
-                                             extensions=self.site.markdown_plugins,
-                                             extension_configs=self.site.markdown_options)
-            if self.template is not None:
-                template = self.site.renderer.get_template(self.template)
+        self.get_content()
+        name = self.get_template_name()
+        with self.site.profile('jinja render', self.filepath, name):
+            template = self.site.renderer.get_template(name)
+            # Inject live reload code (optional)
+            if self.site.preview_mode:
+                livejs_code = "<script>"+livereload_script()+"</script>"
             else:
-                template = self.site.renderer.get_template("markdown.html")
-        else:
-            template = self.site.renderer.get_template(self.filepath)
-        # Inject livejs code (optional)
-        if self.site.preview_mode:
-            livejs_code = "<script>"+livejs+"</script>"
-        else:
-            livejs_code = ""
-        self.rendered = template.render(self.__dict__, site=self.site, livejs=livejs_code)
+                livejs_code = ""
+            # asset_url is passed in rather than made a Jinja global so the
+            # dependency graph sees which templates use it
+            self.rendered = template.render(self.__dict__, body=self.body, site=self.site, livejs=livejs_code,
+                                            asset_url=self.site.asset_url)
+        return self.rendered
+
+    def get_content(self):
+        """
+        Convert the markdown body to HTML. The result is kept until the page is
+        invalidated so the page itself and anything that embeds it (like a
+        feed) only convert it once per build.
+        """
+        if self.ext not in [".md", ".markdown"]:
+            return None
+        if self.content is None:
+            with self.site.profile('markdown', self.filepath):
+                self.content = self.site.convert_markdown(self.body)
+        return self.content
+
+    def get_rendered(self):
+        """
+        Get the rendered page, rendering it only if it hasn't been rendered
+        since it was last invalidated.
+        """
+        if self.rendered is None:
+            self.render()
         return self.rendered
 
+    def invalidate(self):
+        """
+        Forget the rendered output so the next render picks up changes to the
+        page or to anything it depends on.
+        """
+        self.content = None
+        self.rendered = None
+
     def render_to_disk(self):
-        output = self.render()
-        target = join(self.site.root, 'output', self.get_target())
-        logging.debug('Writing to %s' % target)
-        ui('Generating %s' % target)
-        target_dir = dirname(target)
-        if not isdir(target_dir):
-            os.makedirs(target_dir)
-        file = codecs.open(target, encoding='utf-8', mode='w')
-        file.write(output)
-        file.close()
+        output = self.get_rendered()
+        if self.site.store is not None:
+            self.site.store.put(self.get_target(), output)
+        if self.site.write_output:
+            target = join(self.site.root, 'output', self.get_target())
+            with self.site.profile('disk write', self.filepath):
+                written = self.site.writer.write(self.get_target(), output.encode('utf-8'))
+            if written:
+                logging.debug('Writing to %s' % target)
+                ui('Generating %s' % target)
+            else:
+                logging.debug('Skipping %s; unchanged', target)
+        self.site.record_output(self.get_target())
+        return output
 
     @classmethod
     def parse_string(cls, filepath, site, text):
@@ -299,13 +1490,12 @@ class Page:
         a page object with metadata and body.
         """
         page = cls(filepath, site)
-        parts = text.split(cls.metadelimiter, 1)
+        page.source_digest = digest(text)
+        metadata, page.body = cls.split(text)
 
-        if len(parts) == 2:
-            page.parse_metadata(parts[0].strip())
-            page.body = parts[1].strip()
+        if metadata is not None:
+            page.parse_metadata(metadata)
         else:
-            page.body = parts[0].strip()
             if page.ext in ['.md', '.markdown']:
                 logging.warning("No metadata detected; expected %s separator %s",
                                 cls.metadelimiter, page.filepath)
@@ -313,16 +1503,467 @@ class Page:
             page.parsed = True
         return page
 
+    @classmethod
+    def split(cls, text):
+        """
+        Split page source into its front matter (None if it has none) and body
+        """
+        parts = text.split(cls.metadelimiter, 1)
+        if len(parts) == 2:
+            return parts[0].strip(), parts[1].strip()
+        return None, parts[0].strip()
+
     @classmethod
     def parse_file(cls, filepath, site):
         """
         Read a file and return the Page created by passing it into parse_string
         """
-        content = codecs.open(filepath, encoding='utf-8').read()
+        with codecs.open(filepath, encoding='utf-8') as f:
+            content = f.read()
         page = cls.parse_string(filepath, site, content)
         return page
 
 
+def escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def format_iso8601(date):
+    if date.tzinfo is None or date.utcoffset() == timedelta(0):
+        return date.replace(tzinfo=None).isoformat() + 'Z'
+    return date.isoformat()
+
+
+class AtomFeed:
+    """
+    Writes an Atom feed for a list of pages. The feed is generated one piece
+    at a time, and each entry reuses the page's converted markdown and parsed
+    date rather than rendering or parsing anything again.
+    """
+    generator = ('Icecake', 'https://github.com/cbednarski/icecake')
+
+    def __init__(self, title, feed_url, subtitle, site_url, author):
+        self.title = title
+        self.feed_url = feed_url
+        self.subtitle = subtitle
+        self.site_url = site_url
+        self.author = author
+
+    def generate(self, pages):
+        dates = [page.published for page in pages if page.published is not None]
+        updated = max(dates) if dates else datetime.utcnow()
+
+        yield '<?xml version="1.0" encoding="utf-8"?>\n'
+        yield '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+        yield '  <title type="text">%s</title>\n' % escape(self.title or '')
+        yield '  <id>%s</id>\n' % escape(self.feed_url or self.site_url or '')
+        yield '  <updated>%s</updated>\n' % format_iso8601(updated)
+        if self.site_url:
+            yield '  <link href="%s" />\n' % escape(self.site_url)
+        if self.feed_url:
+            yield '  <link href="%s" rel="self" />\n' % escape(self.feed_url)
+        if not self.author:
+            # Atom needs an author for the feed if the entries don't have one
+            yield '  <author>\n    <name>Unknown author</name>\n  </author>\n'
+        if self.subtitle:
+            yield '  <subtitle type="text">%s</subtitle>\n' % escape(self.subtitle)
+        yield '  <generator uri="%s">%s</generator>\n' % (escape(self.generator[1]), escape(self.generator[0]))
+        for page in pages:
+            for piece in self.generate_entry(page, updated):
+                yield piece
+        yield '</feed>\n'
+
+    def generate_entry(self, page, updated):
+        url = (self.site_url or '') + page.url
+        yield '  <entry>\n'
+        yield '    <title type="text">%s</title>\n' % escape(page.title or '')
+        yield '    <id>%s</id>\n' % escape(url)
+        if page.published is not None:
+            published = format_iso8601(page.published)
+            yield '    <updated>%s</updated>\n' % published
+            yield '    <published>%s</published>\n' % published
+        else:
+            yield '    <updated>%s</updated>\n' % format_iso8601(updated)
+        yield '    <link href="%s" />\n' % escape(url)
+        if self.author:
+            yield '    <author>\n      <name>%s</name>\n    </author>\n' % escape(self.author)
+        content = page.get_content()
+        if content:
+            yield '    <content type="html">%s</content>\n' % escape(content)
+        yield '  </entry>\n'
+
+
+# The only way to read the umask is to set it, which would affect files
+# other threads create meanwhile, so we read it once while importing
+umask = os.umask(0)
+os.umask(umask)
+
+
+class OutputWriter:
+    """
+    Writes files to the output folder. Files whose content didn't change are
+    left alone, so their mtime stays put and tools like rsync don't copy them
+    again. Everything else is written atomically, so a build that crashes
+    part way never leaves a truncated file behind.
+
+    digests maps targets to the hash of what we last wrote there (the build
+    fills it in from the manifest). If the new content hashes differently we
+    write without looking at the old file; otherwise we compare with the file
+    on disk to be sure. Folders we've created or seen are remembered so we
+    don't check for them again on every write.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.digests = {}
+        self.folders = set()
+        self.lock = threading.Lock()
+        # New files get the permissions a plain open() would give them
+        self.mode = 0o666 & ~umask
+
+    def reset(self):
+        """Forget everything, such as after the output folder was removed"""
+        with self.lock:
+            self.digests = {}
+            self.folders = set()
+
+    def make_folder(self, folder):
+        if folder in self.folders:
+            return
+        make_folder(folder)
+        with self.lock:
+            self.folders.add(folder)
+
+    def is_current(self, path, data):
+        try:
+            if os.stat(path).st_size != len(data):
+                return False
+            with open(path, 'rb') as f:
+                return f.read() == data
+        except (IOError, OSError):
+            return False
+
+    def write(self, target, data):
+        """
+        Write data (bytes) to target, relative to the output folder, unless
+        it's already there. Returns whether we wrote anything.
+        """
+        path = join(self.root, target)
+        new = digest(data)
+        known = self.digests.get(target)
+        if (known is None or known == new) and self.is_current(path, data):
+            self.digests[target] = new
+            return False
+        folder = dirname(path)
+        self.make_folder(folder)
+        try:
+            write_atomic(path, data, self.mode)
+        except OSError:
+            # Someone removed the folder since we saw it
+            if isdir(folder):
+                raise
+            with self.lock:
+                self.folders.discard(folder)
+            self.make_folder(folder)
+            write_atomic(path, data, self.mode)
+        self.digests[target] = new
+        return True
+
+    def forget(self, target):
+        self.digests.pop(target, None)
+
+
+def compress(data, encoding):
+    """
+    Compress data for a Content-Encoding. gzip output has no timestamp, so
+    the same input always gives the same bytes.
+    """
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data)
+    import gzip
+    import io
+    buffer = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buffer, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def _compress_file(task):
+    """
+    Compress one output file for Precompressor, unless it has the content
+    it had last time and its compressed files are still there. Returns the
+    target, its hash, and the encodings we have a compressed file for.
+    """
+    path, target, previous, encodings, mode = task
+    with open(path, 'rb') as f:
+        data = f.read()
+    content = digest(data)
+    if previous is not None and previous[0] == content and \
+            all(isfile('%s.%s' % (path, encoding)) for encoding in previous[1]):
+        return target, content, previous[1], False
+    written = []
+    for encoding in encodings:
+        compressed = compress(data, encoding)
+        sibling = '%s.%s' % (path, encoding)
+        if len(compressed) < len(data):
+            write_atomic(sibling, compressed, mode)
+            written.append(encoding)
+        elif isfile(sibling):
+            # It doesn't help for this file any more
+            os.remove(sibling)
+    return target, content, written, True
+
+
+class Precompressor:
+    """
+    Writes .gz (and .br, if the brotli module is installed) next to output
+    files that compress well, so servers like nginx with gzip_static can send
+    them as they are. Files are compressed by a pool of processes. We keep a
+    hash of each file we compressed in the cache folder and skip files whose
+    content hasn't changed since.
+    """
+    version = 1
+    extensions = ['.html', '.htm', '.css', '.js', '.mjs', '.json', '.xml', '.svg', '.txt', '.md',
+                  '.map', '.ico', '.wasm', '.ttf', '.otf']
+    threshold = 1024  # Smaller files aren't worth compressing
+
+    def __init__(self, path, mode=0o644):
+        self.path = path
+        self.mode = mode
+        self.encodings = ['gz']
+        try:
+            import brotli  # noqa: F401
+            self.encodings.append('br')
+        except ImportError:
+            pass
+        self.files = {}
+
+    def load(self):
+        self.files = {}
+        try:
+            with codecs.open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') == self.version and data.get('encodings') == self.encodings:
+            self.files = data.get('files', {})
+
+    def save(self):
+        make_folder(dirname(self.path))
+        data = {'version': self.version, 'encodings': self.encodings, 'files': self.files}
+        write_atomic(self.path, json.dumps(data, indent=1, sort_keys=True).encode('utf-8'))
+
+    def is_compressible(self, path):
+        if splitext(path)[1].lower() not in self.extensions:
+            return False
+        try:
+            return os.stat(path).st_size >= self.threshold
+        except OSError:
+            return False
+
+    def run(self, root, targets, jobs=1):
+        """
+        Compress targets (relative to root) that need it. Returns the
+        compressed files that belong in root, relative to root, and how many
+        files we compressed this time.
+        """
+        self.load()
+        tasks = [(join(root, target), target, self.files.get(target), self.encodings, self.mode)
+                 for target in sorted(targets) if self.is_compressible(join(root, target))]
+        if jobs > 1 and len(tasks) > 1:
+            from multiprocessing import Pool
+            pool = Pool(min(jobs, len(tasks)))
+            try:
+                results = pool.map(_compress_file, tasks, max(1, len(tasks) // (jobs * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_compress_file(task) for task in tasks]
+        self.files = {}
+        siblings = []
+        compressed = 0
+        for target, content, encodings, changed in results:
+            self.files[target] = [content, encodings]
+            siblings.extend('%s.%s' % (target, encoding) for encoding in encodings)
+            compressed += changed
+        self.save()
+        return siblings, compressed
+
+
+css_url = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+
+
+class AssetManifest:
+    """
+    Maps static files to fingerprinted names that include a hash of their
+    content, like css/main.css to css/main.0123456789ab.css, so they can be
+    cached forever: a changed file gets a new name. Only the kinds of files
+    pages link to are fingerprinted; things like robots.txt keep their names.
+
+    Hashing every asset on every build would be slow, so we remember each
+    file's hash with its size and mtime in the cache folder and only hash
+    files again when those change. Stylesheets are the exception: url()s in
+    them are rewritten to the fingerprinted names of what they point to, and
+    the stylesheet is named after the hash of the result, so they're read
+    on every build.
+    """
+    version = 1
+    extensions = ['.css', '.js', '.mjs', '.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.avif',
+                  '.woff', '.woff2', '.ttf', '.otf', '.eot']
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}   # static file -> [size, mtime, hash]
+        self.targets = {}  # static file -> fingerprinted name
+        self.rewritten = {}  # stylesheet -> its content with url()s rewritten
+
+    def load(self):
+        self.hashes = {}
+        try:
+            with codecs.open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if data.get('version') == self.version:
+            self.hashes = data.get('hashes', {})
+
+    def save(self):
+        make_folder(dirname(self.path))
+        data = {'version': self.version, 'hashes': self.hashes}
+        write_atomic(self.path, json.dumps(data, indent=1, sort_keys=True).encode('utf-8'))
+
+    def fingerprint(self, path, content_hash):
+        base, ext = splitext(path)
+        return '%s.%s%s' % (base, content_hash[:12], ext)
+
+    def update(self, root, sources):
+        """
+        Fingerprint the sources (relative to root) that we fingerprint at all
+        """
+        self.load()
+        hashes = {}
+        self.targets = {}
+        self.rewritten = {}
+        stylesheets = []
+        for source in sources:
+            ext = splitext(source)[1].lower()
+            if ext not in self.extensions:
+                continue
+            if ext == '.css':
+                stylesheets.append(source)
+                continue
+            stat = os.stat(join(root, source))
+            entry = self.hashes.get(source)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime]:
+                entry = [stat.st_size, stat.st_mtime, file_digest(join(root, source))]
+            hashes[source] = entry
+            self.targets[source] = self.fingerprint(source, entry[2])
+        stylesheets = set(stylesheets)
+        for source in sorted(stylesheets):
+            self.rewrite_css(root, source, stylesheets, set())
+        if hashes != self.hashes:
+            self.hashes = hashes
+            self.save()
+
+    def rewrite_css(self, root, source, stylesheets, seen):
+        """
+        Point the url()s in a stylesheet at fingerprinted names, then
+        fingerprint the stylesheet by the result. Stylesheets it imports are
+        done first, since their names are part of it; seen breaks cycles.
+        """
+        if source in self.targets or source in seen:
+            return
+        seen.add(source)
+        with open(join(root, source), 'rb') as f:
+            text = f.read().decode('utf-8')
+        folder = posixpath.dirname(source.replace(os.sep, '/'))
+
+        def replace(match):
+            url = match.group(2).strip()
+            path, suffix = re.match(r'([^?#]*)(.*)$', url).groups()
+            if not path or ':' in path or path.startswith('//'):
+                return match.group(0)  # data: URLs, other sites, fragments
+            if path.startswith('/'):
+                linked = posixpath.normpath(path.lstrip('/'))
+            else:
+                linked = posixpath.normpath(posixpath.join(folder, path))
+            linked = linked.replace('/', os.sep)
+            if linked in stylesheets:
+                self.rewrite_css(root, linked, stylesheets, seen)
+            if linked not in self.targets:
+                return match.group(0)
+            name = posixpath.basename(self.targets[linked])
+            path = posixpath.join(posixpath.dirname(path), name)
+            return 'url(%s%s%s%s)' % (match.group(1), path, suffix, match.group(1))
+
+        data = css_url.sub(replace, text).encode('utf-8')
+        self.targets[source] = self.fingerprint(source, digest(data))
+        self.rewritten[source] = data
+
+    def get_target(self, source):
+        return self.targets.get(source, source)
+
+
+class StoredOutput:
+    def __init__(self, target, body=None, source=None):
+        self.target = target  # Path relative to output
+        self.body = body  # Rendered page as bytes
+        self.source = source  # Static file to serve instead of a body
+        self.modified = time.time()
+        self.etag = digest(body) if body is not None else None
+
+
+class OutputStore:
+    """
+    Rendered output kept in memory and keyed by URL, so the preview server can
+    answer straight from what the watcher rendered instead of going through
+    the output folder. Pages are stored as bytes. Static files are stored as
+    the path of their source so we don't have to copy them anywhere.
+
+    The watcher writes from its own thread while the server reads, so every
+    change goes through a lock.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def put(self, target, output):
+        """Store a rendered page; target is relative to the output folder"""
+        entry = StoredOutput(target, body=output.encode('utf-8'))
+        with self.lock:
+            self.entries[output_url(target)] = entry
+
+    def put_file(self, target, source):
+        """Serve the file at source for target"""
+        entry = StoredOutput(target, source=source)
+        with self.lock:
+            self.entries[output_url(target)] = entry
+
+    def remove(self, target):
+        with self.lock:
+            self.entries.pop(output_url(target), None)
+
+    def get(self, path):
+        """
+        Find the output for a request path. The query string is ignored and
+        the path is normalized, so .. can't escape the site.
+        """
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        url = '/' + posixpath.normpath(unquote(path)).lstrip('/')
+        if path.endswith('/') and url != '/':
+            url += '/'
+        if posixpath.basename(url) == 'index.html':
+            url = url[:-len('index.html')]
+        with self.lock:
+            return self.entries.get(url)
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class Site:
     """
     A site represents a collection of source files arranged under the following
@@ -343,16 +1984,37 @@ class Site:
     building your site.
     """
 
-    def __init__(self, root, preview_mode=False):
+    def __init__(self, root, preview_mode=False, markdown_engine=MarkdownEngine.name,
+                 store=None, write_output=True, profiler=None, cache_budget=None, fingerprint=False):
         """
         Keyword Arguments:
         root -- The path to the static site folder which includes the pages,
                 layouts, and static folders.
+        preview_mode -- Inject livejs into pages for the preview server.
+        markdown_engine -- The name of the engine in markdown_engines used to
+                convert markdown.
+        store -- An OutputStore that receives everything we render or copy.
+        write_output -- Whether rendered pages and static files are written to
+                the output folder. Turn this off to keep them only in store.
+        profiler -- A Profiler that records where the time goes.
+        cache_budget -- How many characters of markdown source to keep in
+                memory; see ContentCache.
+        fingerprint -- Copy static assets to names that include a hash of
+                their content when building; see AssetManifest.
         """
+        self.fingerprint = fingerprint
         self.preview_mode = preview_mode
+        self.store = store
+        self.write_output = write_output
+        self.profiler = profiler
         self.root = abspath(root)
-        self.cache = ContentCache(root)
-        self.cache.warm()
+        self.ignore = IgnoreRules.load(self.root)
+        self.cache = ContentCache(root, self.ignore, cache_budget)
+        # Pages are parsed as they're read, so a site bigger than the cache
+        # budget doesn't have to read evicted pages again to parse them
+        self.preparsed = {}
+        with self.profile('cache warm'):
+            self.cache.warm(loaded=self.preparse)
         self.markdown_plugins = ["markdown.extensions.fenced_code", "markdown.extensions.codehilite"]
         self.markdown_options = {
             "codehilite": {
@@ -360,10 +2022,74 @@ class Site:
                 "guess_lang": False,
             }
         }
-        self.renderer = jinja2.Environment(loader=jinja2.DictLoader(self.cache.templates))
+        self.renderer = jinja2.Environment(loader=CacheLoader(self.cache))
+        self.cache_dir = join(self.root, '.icecake-cache')
+        self.manifest = BuildManifest(join(self.cache_dir, 'manifest.json'))
+        self.writer = OutputWriter(join(self.root, 'output'))
+        self.precompressor = Precompressor(join(self.cache_dir, 'compressed.json'), self.writer.mode)
+        self.assets = AssetManifest(join(self.cache_dir, 'assets.json'))
+        self.markdown_engine = markdown_engine
+        self.engine = None
+        self.markdown_cache = MarkdownCache()
+        self.highlight_cache = HighlightCache()
+        self.graph = DependencyGraph(self.renderer)
+        for name, source in self.cache.templates.items():
+            self.graph.update_template(name, source)
         self.pagedata = {}
+        self.index = None
+        self.feeds = {}
+        self.listeners = []
+        self.written = []
         self.get_pages()
 
+    def profile(self, phase, page=None, template=None):
+        """
+        Measure a phase of the build if we're profiling; see Profiler.measure
+        """
+        if self.profiler is None:
+            return NullSpan()
+        return self.profiler.measure(phase, page, template)
+
+    def cache_templates(self):
+        """
+        Keep compiled templates in the cache folder so later runs only compile
+        templates that changed
+        """
+        folder = join(self.cache_dir, 'jinja')
+        if not isdir(folder):
+            os.makedirs(folder)
+        self.renderer.bytecode_cache = jinja2.FileSystemBytecodeCache(folder)
+
+    def convert_markdown(self, body):
+        """
+        Convert markdown to HTML, reusing an earlier conversion of the same
+        markdown with the same settings if we have one
+        """
+        engine = self.get_markdown_engine()
+        key = self.markdown_cache.key(body, engine)
+        html = self.markdown_cache.get(key)
+        if html is None:
+            html = engine.convert(body)
+            self.markdown_cache.set(key, html)
+        return html
+
+    def get_markdown_engine(self):
+        """
+        Get the engine selected by markdown_engine, creating it again if the
+        engine or the markdown settings were replaced
+        """
+        engine = self.engine
+        if (engine is None or engine.name != self.markdown_engine or
+                engine.extensions is not self.markdown_plugins or
+                engine.options is not self.markdown_options):
+            if self.markdown_engine not in markdown_engines:
+                raise ValueError("Unknown markdown engine %s; expected one of %s" %
+                                 (self.markdown_engine, ", ".join(sorted(markdown_engines))))
+            engine = markdown_engines[self.markdown_engine](self.markdown_plugins, self.markdown_options,
+                                                            self.highlight_cache)
+            self.engine = engine
+        return engine
+
     def get_target(self, path):
         """Convert a path from static to output"""
         path = self.relpath(path)
@@ -384,93 +2110,521 @@ class Site:
     def is_static(self, path):
         return self.relpath(path).startswith('static')
 
-    def copy_static(self, path):
+    def asset_url(self, path):
+        """
+        Get the URL of a static file, which is its fingerprinted name if we
+        are fingerprinting assets. Templates use this to link to assets.
+        """
+        path = path.lstrip('/')
+        return '/' + self.assets.get_target(path).replace(os.sep, '/')
+
+    def hash_assets(self):
+        """
+        Work out the fingerprinted names of the static files before pages
+        that link to them are rendered
+        """
+        if self.fingerprint:
+            sources = scan(self.root, 'static', self.ignore)
+            self.assets.update(join(self.root, 'static'), sorted(sources))
+        else:
+            self.assets.targets = {}
+            self.assets.rewritten = {}
+
+    def copy_static(self, path, link=False):
         source = join(self.root, 'static', path)
-        target = self.get_target(source)
-        target_dir = dirname(target)
-        if not isdir(target_dir):
-            logging.debug('Creating directory %s' % target_dir)
-            os.makedirs(target_dir, mode=0o755)
+        target = join(self.root, 'output', self.assets.get_target(path))
+        if path in self.assets.rewritten:
+            # A fingerprinted stylesheet, which links to fingerprinted names
+            data = self.assets.rewritten[path]
+            if self.store is not None:
+                self.store.put(self.assets.get_target(path), data)
+            if self.write_output:
+                self.writer.write(self.assets.get_target(path), data)
+            self.record_output(self.assets.get_target(path))
+            return
+        if self.store is not None:
+            self.store.put_file(relpath(target, join(self.root, 'output')), source)
+        if not self.write_output:
+            self.record_output(relpath(target, join(self.root, 'output')))
+            return
+        self.writer.make_folder(dirname(target))
         logging.debug('Copying static file to %s' % target)
-        shutil.copy(source, target)
+        with self.profile('static copy'):
+            copy_file(source, target, link=link)
+        self.record_output(relpath(target, join(self.root, 'output')))
+
+    def is_synced(self, source, checksum=False):
+        """Check whether the output already has an up-to-date copy of a static file"""
+        target = join(self.root, 'output', self.assets.get_target(source))
+        if source in self.assets.rewritten:
+            # Rewritten stylesheets are named after their content
+            return isfile(target)
+        return is_same_file(join(self.root, 'static', source), target, checksum)
+
+    def sync_static(self, checksum=False, link=False, threads=8):
+        """
+        Copy static files that are missing or changed in the output folder,
+        using a pool of threads. Files are compared by size and modification
+        time, or by hash if checksum is True. Pass link=True to hard link files
+        instead of copying them when the filesystem allows it. Returns the
+        files we put in output, relative to output.
+        """
+        logging.debug('Syncing static files')
+        sources = sorted(scan(self.root, 'static', self.ignore))
+        changed = [source for source in sources if not self.is_synced(source, checksum)]
+        logging.debug('%d of %d static files changed', len(changed), len(sources))
+        if len(changed) > 1 and threads > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(threads, len(changed)))
+            try:
+                pool.map(lambda source: self.copy_static(source, link=link), changed)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for source in changed:
+                self.copy_static(source, link=link)
+        return [self.assets.get_target(source) for source in sources]
 
-    def copy_all_static(self):
-        logging.debug('Copying static files')
-        static_dir = join(self.root, 'static')
-        sources = ls_relative(static_dir)
-        for source in sources:
-            if isfile(join(self.root, 'static', source)):
-                self.copy_static(source)
+    def fill_store(self):
+        """
+        Put every page and static file in the store, rendering pages that
+        haven't been rendered yet. Nothing is written to the output folder.
+        """
+        for filepath in sorted(self.pagedata):
+            page = self.pagedata[filepath]
+            self.store.put(page.get_target(), page.get_rendered())
+        for source in scan(self.root, 'static', self.ignore):
+            path = join(self.root, 'static', source)
+            if isfile(path):
+                self.store.put_file(source, path)
+        logging.debug('Stored %d outputs in memory', len(self.store))
+
+    def prune_output(self, expected):
+        """
+        Delete files in the output folder that the build did not produce, such
+        as static files that were removed, along with any empty folders.
+        """
+        output_dir = join(self.root, 'output')
+        for file in ls_relative(output_dir):
+            if file not in expected:
+                logging.debug('Removing orphaned output %s', file)
+                os.remove(join(output_dir, file))
+                self.writer.forget(file)
+        for path, dirs, files in os.walk(output_dir, topdown=False):
+            if path != output_dir and not os.listdir(path):
+                os.rmdir(path)
+                self.writer.folders.discard(path)
+
+    def discover(self):
+        """
+        List the page sources under content, relative to the site root. These
+        come from the content cache so we don't go back to the disk for them.
+        """
+        return sorted(file for file in self.cache.files if file.startswith('content'))
+
+    def parse_page(self, file):
+        """
+        Parse a page source from the content cache into a Page. This reads the
+        metadata but does not render anything.
+        """
+        return self.parse_pages([file])[0]
+
+    def parse_pages(self, files):
+        """
+        Parse several page sources from the content cache into Pages, in the
+        same order. get_pages uses this for the whole site at once.
+        """
+        pages = []
+        for file in files:
+            page = self.preparsed.pop(file, None)
+            if page is None:
+                page = self.parse_source(file, self.cache.get(file))
+            pages.append(page)
+        return pages
+
+    def preparse(self, file, source):
+        """Parse a page as the content cache reads it; see parse_pages"""
+        if file.startswith('content'):
+            self.preparsed[file] = self.parse_source(file, source)
+
+    def parse_source(self, file, source):
+        with self.profile('metadata parse', relpath(file, 'content')):
+            page = Page.parse_string(join(self.root, file), self, source)
+        # The content cache holds the body for us
+        page.body = None
+        return page
 
     def get_pages(self):
         """
-        Enumerate and parse all the page files in the static site.
+        Enumerate and parse all the page files in the static site. Pages are
+        rendered later, on demand, so this is cheap.
         """
         logging.debug("Getting pages")
         pages = {}
-        for file in self.cache.files:
-            if not file.startswith('content'):
-                continue
-            source_file = join(self.root, file)
-            if isfile(source_file):
-                logging.debug("Parsing %s", source_file)
-                page = Page.parse_file(source_file, self)
-                page.render()
-                pages[page.filepath] = page
+        for page in self.parse_pages(self.discover()):
+            pages[page.filepath] = page
+            self.graph.update_page(page.filepath, page.get_template_name())
+        self.preparsed = {}
         self.pagedata = pages
+        self.index = None
+        self.feeds = {}
         return self.pagedata
 
-    def list_dependents(self, filepath):
-        depset = set()
-        # If the page is markdown.html then we need to add all of the markdown
-        # pages.
-        # TODO add support for markdown pages that specify a custom template
-        if filepath == 'markdown.html':
-            for _, page in self.pagedata.items():
-                if page.ext in ['.md', '.markdown']:
-                    depset.add(page.filepath)
+    def update_page(self, file):
+        """
+        Parse a page again after its source changed and put it in place of the
+        old one. Any page may list this one, so rendered output is invalidated.
+        """
+        page = self.parse_page(file)
+        self.pagedata[page.filepath] = page
+        self.index = None
+        self.feeds = {}
+        self.graph.update_page(page.filepath, page.get_template_name())
+        if page.filepath in self.cache.templates:
+            self.graph.update_template(page.filepath, self.cache.templates[page.filepath])
+        self.invalidate()
+        return page
+
+    def remove_page(self, file):
+        """
+        Forget a page after its source was deleted and remove its output
+        """
+        self.cache.delete(file)
+        filepath = relpath(file, 'content')
+        page = self.pagedata.pop(filepath, None)
+        self.index = None
+        self.feeds = {}
+        self.graph.remove_page(filepath)
+        self.update_template(filepath)
+        if page is not None:
+            self.remove_output(page.get_target())
+
+    def remove_output(self, target):
+        """
+        Delete target (relative to the output folder) from the store, and
+        from the output folder if we're writing it
+        """
+        if self.store is not None:
+            self.store.remove(target)
+        path = join(self.root, 'output', target)
+        self.writer.forget(target)
+        if self.write_output and isfile(path):
+            logging.debug('Removing %s', path)
+            os.remove(path)
+        self.record_output(target)
+
+    def update_static(self, path):
+        """
+        Copy a static file after it changed, or remove its output if it was
+        deleted. path is relative to the site root.
+        """
+        target = relpath(path, 'static')
+        if isfile(join(self.root, path)):
+            output = join(self.root, 'output', self.assets.get_target(target))
+            if not (self.write_output and is_same_file(join(self.root, path), output)):
+                self.copy_static(target)
+        elif target not in set(page.get_target() for page in self.pagedata.values()):
+            self.remove_output(target)
+
+    def expand_changes(self, paths):
+        """
+        Turn a list of changed paths into the files that may have changed. A
+        folder stands for the files inside it now and the files we knew were
+        inside it before, so folders that were moved or deleted are handled
+        too.
+        """
+        found = set()
+        for path in paths:
+            folder = join(self.root, path)
+            if isfile(folder):
+                found.add(path)
+                continue
+            found.update(join(path, file) for file in scan(self.root, path, self.ignore))
+            prefix = path + os.sep
+            found.update(file for file in self.cache.files if file.startswith(prefix))
+            if self.is_static(path):
+                output = join(self.root, 'output', relpath(path, 'static'))
+                found.update(join(path, file) for file in ls_relative(output))
+            found.add(path)
+        return sorted(file for file in found
+                      if not isdir(join(self.root, file)) and not self.ignore.ignores(file))
+
+    def apply_changes(self, paths):
+        """
+        Bring the site up to date after the files at paths (relative to the
+        root) were created, changed, or deleted. Pages affected by several of
+        the changes are only rendered once.
+        """
+        render = set()
+        changed = set()
+        pages_changed = False
+        for path in self.expand_changes(paths):
+            if self.is_static(path):
+                self.update_static(path)
+            elif self.is_content(path) or self.is_layout(path):
+                name = relpath(path, 'content' if self.is_content(path) else 'layouts')
+                if isfile(join(self.root, path)):
+                    if not self.cache.refresh(path):
+                        continue
+                    logging.debug('Change detected for %s', path)
+                    if self.is_content(path):
+                        render.add(self.update_page(path).filepath)
+                    else:
+                        self.update_template(name)
+                elif path in self.cache.files:
+                    logging.debug('Deletion detected for %s', path)
+                    if self.is_content(path):
+                        self.remove_page(path)
+                    else:
+                        self.cache.delete(path)
+                        self.update_template(name)
+                else:
+                    continue
+                changed.add(name)
+                pages_changed = pages_changed or self.is_content(path)
+        if not changed:
+            return
+        self.invalidate()
+        for name in changed:
+            render.update(self.list_dependents(name))
+        if pages_changed:
+            # Listings and feeds can show any page, as in get_inputs
+            render.update(self.list_site_users())
+        for filepath in sorted(render):
+            if filepath in self.pagedata:
+                self.pagedata[filepath].render_to_disk()
+
+    def list_site_users(self):
+        """
+        List the pages whose templates use `site`, which can show any other
+        page, so they need rendering whenever any page changes
+        """
+        return [filepath for filepath, page in self.pagedata.items()
+                if 'site' in self.graph.list_templates(page.get_template_name())[1]]
+
+    def update_template(self, name):
+        """
+        Update the dependency graph after a layout changed
+        """
+        if name in self.cache.templates:
+            self.graph.update_template(name, self.cache.templates[name])
         else:
-            for path, body in self.cache.templates.items():
-                ast = self.renderer.parse(body)
-                pagedeps = jinja2.meta.find_referenced_templates(ast)
-                if filepath in pagedeps:
-                    for item in self.list_dependents(path):
-                        depset.add(item)
-            for _, page in self.pagedata.items():
-                ast = self.renderer.parse(page.body)
-                pagedeps = jinja2.meta.find_referenced_templates(ast)
-                if filepath in list(pagedeps):
-                    depset.add(page.filepath)
-                    for item in self.list_dependents(page.filepath):
-                        depset.add(item)
-        deplist = list(depset)
-        deplist.sort()
-        return deplist
+            self.graph.remove_template(name)
+
+    def invalidate(self):
+        """
+        Forget all rendered output so pages are rendered again the next time
+        they are needed.
+        """
+        for page in self.pagedata.values():
+            page.invalidate()
+
+    def list_dependents(self, filepath):
+        """
+        List the pages that need to be rendered again when the named template
+        or page changes
+        """
+        return self.graph.list_dependents(filepath)
+
+    def record_output(self, target):
+        """
+        Remember that we wrote target (relative to the output folder) so the
+        next publish can tell listeners about it. We only keep track while
+        someone is listening.
+        """
+        if self.listeners:
+            self.written.append(target)
+
+    def publish(self):
+        """
+        Tell listeners which URLs changed since the last publish. Each listener
+        is called with a sorted list of URLs, such as the preview server's
+        events queue.
+        """
+        urls = sorted(set(output_url(target) for target in self.written))
+        self.written = []
+        if urls:
+            logging.debug('Publishing changes to %s', ', '.join(urls))
+            for listener in self.listeners:
+                listener(urls)
 
     def render_dependents(self, filepath):
+        self.invalidate()
         for item in self.list_dependents(filepath):
             self.pagedata[item].render_to_disk()
 
-    def build(self):
+    def get_options(self):
+        """
+        Hash the settings that affect every page. If these change we can't
+        trust anything we built before.
+        """
+        return digest(json.dumps({
+            'preview_mode': self.preview_mode,
+            'markdown_engine': self.markdown_engine,
+            'markdown_version': self.get_markdown_engine().version(),
+            'jinja_version': jinja2.__version__,
+            'markdown_plugins': self.markdown_plugins,
+            'markdown_options': self.markdown_options,
+        }, sort_keys=True))
+
+    def get_globals(self):
+        """
+        Hash the site-wide data templates can reach. Any page whose templates
+        use `site` may list other pages, so it depends on all of them. Pages
+        that use `asset_url` depend on the fingerprinted asset names.
+        """
+        sources = ['%s %s' % (path, self.pagedata[path].source_digest)
+                   for path in sorted(self.pagedata)]
+        return {
+            'site': digest('\n'.join(sources)),
+            'asset_url': digest(json.dumps(self.assets.targets, sort_keys=True)),
+        }
+
+    def get_inputs(self, page, site_globals):
+        """
+        Collect the hashes of everything that goes into rendering a page
+        """
+        used, variables = self.graph.list_templates(page.get_template_name())
+        return {
+            'source': page.source_digest,
+            'templates': used,
+            'globals': dict((name, site_globals[name]) for name in variables if name in site_globals),
+        }
+
+    def remove_stale_outputs(self):
+        """
+        Delete output files left behind by pages that were removed or renamed
+        since the last build.
+        """
+        targets = set(page.get_target() for page in self.pagedata.values())
+        for filepath, entry in list(self.manifest.pages.items()):
+            page = self.pagedata.get(filepath)
+            if page is not None and page.get_target() == entry['target']:
+                continue
+            self.manifest.forget(filepath)
+            target = join(self.root, 'output', entry['target'])
+            if entry['target'] not in targets and isfile(target):
+                logging.debug('Removing stale output %s', target)
+                os.remove(target)
+
+    def render_pages(self, filepaths, jobs=1):
+        """
+        Render pages to disk, yielding the filepath and output hash of each
+        page. With more than one job the pages are split into chunks and
+        rendered by a pool of worker processes, which write their own output.
+        """
+        global _worker_site
+        if jobs <= 1 or len(filepaths) < 2:
+            for filepath in filepaths:
+                yield filepath, digest(self.pagedata[filepath].render_to_disk())
+            return
+
+        size = max(1, len(filepaths) // (jobs * 4))
+        chunks = [filepaths[i:i + size] for i in range(0, len(filepaths), size)]
+        # Forked workers pick the parsed site up from here instead of parsing
+        # everything again
+        _worker_site = self
+        from multiprocessing import Pool
+        pool = Pool(jobs, _init_worker, (self.root, self.preview_mode, self.markdown_engine,
+                                         self.markdown_plugins, self.markdown_options, self.assets.targets))
+        try:
+            for results in pool.imap_unordered(_render_chunk, chunks):
+                for result in results:
+                    yield result
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            _worker_site = None
+
+    def build(self, full=False, jobs=None, checksum=False, link=False, compress=False):
         """
         Build the site. This method originates all of the calls to discover,
         render, and place pages in the output directory. If you want to
         customize how your site is built, this is a good place to start.
+
+        By default only pages whose inputs changed since the last build are
+        rendered again. Pass full=True to clean the output folder and render
+        everything from scratch. Pass jobs to render pages (and compress
+        output) in parallel using that many processes. Static files are synced rather than copied; see
+        sync_static for checksum and link. Pass compress to write gzip (and
+        brotli) versions of the output; see Precompressor.
         """
-        self.clean_output()
-        self.pagedata = self.get_pages()
+        options = self.get_options()
+        self.markdown_cache.path = join(self.cache_dir, 'markdown')
+        self.highlight_cache.path = join(self.cache_dir, 'pygments')
+        self.cache_templates()
+        if full:
+            self.clean_output()
+            self.manifest.reset()
+            self.markdown_cache.clear()
+            self.highlight_cache.clear()
+            self.renderer.bytecode_cache.clear()
+        else:
+            self.manifest.load()
+            if self.manifest.options != options:
+                self.manifest.reset()
+        self.manifest.options = options
+        for entry in self.manifest.pages.values():
+            self.writer.digests[entry['target']] = entry['output']
+        self.invalidate()
+        self.remove_stale_outputs()
+        self.hash_assets()
+        site_globals = self.get_globals()
+        stale = {}
         for _, page in self.pagedata.items():
-            page.render_to_disk()
-        self.copy_all_static()
+            target = page.get_target()
+            inputs = self.get_inputs(page, site_globals)
+            if self.manifest.is_fresh(page.filepath, inputs, target, join(self.root, 'output', target)):
+                logging.debug("Skipping %s; unchanged since last build", page.filepath)
+                continue
+            stale[page.filepath] = (inputs, target)
+        for filepath, output in self.render_pages(sorted(stale), jobs or 1):
+            inputs, target = stale[filepath]
+            self.manifest.record(filepath, inputs, target, output)
+        expected = set(page.get_target() for page in self.pagedata.values())
+        expected.update(self.sync_static(checksum=checksum, link=link))
+        if self.fingerprint:
+            self.writer.write('asset-manifest.json', json.dumps(
+                dict((source.replace(os.sep, '/'), self.asset_url(source)) for source in self.assets.targets),
+                indent=1, sort_keys=True).encode('utf-8'))
+            expected.add('asset-manifest.json')
+        if compress:
+            self.compress_output(expected, jobs)
+        self.prune_output(expected)
+        self.markdown_cache.prune()
+        self.highlight_cache.prune()
+        self.manifest.save()
+
+    def compress_output(self, expected, jobs=None):
+        """
+        Write compressed versions of the output files in expected and add
+        them to it so prune_output keeps them. Compression uses jobs
+        processes, or one per CPU if jobs isn't given.
+        """
+        if jobs is None:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        with self.profile('compress'):
+            siblings, compressed = self.precompressor.run(join(self.root, 'output'), expected, jobs)
+        if compressed:
+            ui('Compressed %d files' % compressed)
+        expected.update(siblings)
+
+    def get_index(self):
+        """
+        Get the index used to query pages, building it if the pages changed
+        """
+        if self.index is None:
+            self.index = PageIndex(self.pagedata)
+        return self.index
 
     def tags(self):
-        tagnames = set()
-        for path, page in self.pagedata.items():
-            if page.tags:
-                tagnames = tagnames.union(set(page.tags))
-        taglist = list(tagnames)
-        taglist.sort()
-        return taglist
+        return list(self.get_index().tags)
 
     def pages(self, path=None, tag=None, limit=None, order=None):
         """
@@ -480,42 +2634,30 @@ class Site:
 
         finder.pages(path="articles", limit=5, order="-date")
         finder.pages(tag="family", order="title")
+
+        Pages that don't have the field used for ordering are listed last.
         """
-        items = self.pagedata.values()
-        for page in items:
-            logging.debug(page.filepath)
-        if path is not None:
-            items = [page for page in items if page.filepath.startswith(path)]
-        if tag is not None:
-            items = [page for page in items if tag in page.tags]
-        if order is not None:
-            rev = False
-            if order[0] == "-":
-                rev = True
-                order = order[1:]
-            items.sort(key=lambda x: getattr(x, order), reverse=rev)
-        if limit is not None and limit > 0:
-            items = items[:limit]
-        return items
+        return self.get_index().query(path=path, tag=tag, limit=limit, order=order)
+
+    def atom_stream(self, feed_title, feed_url, feed_subtitle, site_url, author, *args, **kwargs):
+        """
+        Generate an Atom feed piece by piece for the pages matching a query.
+        The query options are the same as for pages().
+        """
+        feed = AtomFeed(feed_title, feed_url, feed_subtitle, site_url, author)
+        return feed.generate(self.pages(*args, **kwargs))
 
     def atom(self, feed_title, feed_url, feed_subtitle, site_url, author, *args, **kwargs):
-        items = self.pages(*args, **kwargs)
-
-        atom = AtomFeed(title=feed_title,
-                        subtitle=feed_subtitle,
-                        feed_url=feed_url,
-                        url=site_url)
-        for item in items:
-            item.render()
-            atom.add(title=item.title,
-                     content=item.content,
-                     content_type='html',
-                     author=author,
-                     url=site_url+item.url,
-                     published=dateparse(item.date),
-                     updated=dateparse(item.date),
-                     xml_base=None)
-        return atom.to_string()
+        """
+        Make an Atom feed for the pages matching a query. Feeds are remembered
+        until the pages change, so the same feed is only generated once.
+        """
+        key = json.dumps([feed_title, feed_url, feed_subtitle, site_url, author, args, kwargs],
+                         sort_keys=True)
+        if key not in self.feeds:
+            self.feeds[key] = ''.join(self.atom_stream(feed_title, feed_url, feed_subtitle,
+                                                       site_url, author, *args, **kwargs))
+        return self.feeds[key]
 
     def clean_output(self):
         """
@@ -524,6 +2666,7 @@ class Site:
         output_dir = join(self.root, 'output')
         if isdir(output_dir):
             shutil.rmtree(output_dir)
+        self.writer.reset()
 
     @classmethod
     def initialize(cls, root):
@@ -542,67 +2685,168 @@ class Site:
         return Site(root)
 
 
-class Handler(watchdog.events.FileSystemEventHandler):
+# This is the site each worker process renders during a parallel build
+_worker_site = None
+
+
+def _init_worker(root, preview_mode, markdown_engine, markdown_plugins, markdown_options, assets):
+    """
+    Prepare a worker process for a parallel build. Forked workers inherit the
+    parsed site from the parent process; otherwise we load it from disk.
+    """
+    global _worker_site
+    if _worker_site is None:
+        _worker_site = Site(root, preview_mode=preview_mode, markdown_engine=markdown_engine)
+        _worker_site.markdown_plugins = markdown_plugins
+        _worker_site.markdown_options = markdown_options
+        _worker_site.assets.targets = assets
+        _worker_site.markdown_cache.path = join(_worker_site.cache_dir, 'markdown')
+        _worker_site.highlight_cache.path = join(_worker_site.cache_dir, 'pygments')
+        _worker_site.cache_templates()
+
+
+def _render_chunk(filepaths):
+    results = []
+    for filepath in filepaths:
+        output = _worker_site.pagedata[filepath].render_to_disk()
+        results.append((filepath, digest(output)))
+    return results
+
+
+class ChangeQueue:
+    """
+    Collects changed paths from the observer thread and hands them out in
+    batches. A batch is ready once nothing has changed for window seconds, so
+    a burst of events (like an editor saving through a temporary file and a
+    rename) turns into one rebuild. Each path appears in a batch only once.
+    """
+
+    def __init__(self, window=0.1):
+        self.window = window
+        self.paths = set()
+        self.first = None
+        self.last = None
+        self.condition = threading.Condition()
+
+    def add(self, path):
+        with self.condition:
+            if not self.paths:
+                self.first = time.time()
+            self.paths.add(path)
+            self.last = time.time()
+            self.condition.notify()
+
+    def get(self):
+        """
+        Wait for the next batch and return its paths, sorted. We don't wait
+        more than ten windows past the first change, so a steady stream of
+        events can't hold up a rebuild forever.
+        """
+        with self.condition:
+            while not self.paths:
+                self.condition.wait(1)
+            while True:
+                now = time.time()
+                remaining = min(self.last + self.window, self.first + self.window * 10) - now
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = sorted(self.paths)
+            self.paths = set()
+            return batch
+
+
+class Handler:
+    """
+    Puts the files that change in content, layouts, or static on the queue.
+    The Watcher takes care of rebuilding them. The observer only needs a
+    dispatch method, so we don't subclass watchdog's handler and don't have
+    to import watchdog until we start watching.
+    """
     site = None
+    queue = None
+    event_types = ('created', 'deleted', 'modified', 'moved')
 
-    def is_watched(self, event):
+    def is_watched(self, path):
         """
         Whether we are watching this path at all. This guards against
         triggering logic on the output folder or other folders the user may
-        have created here.
-        """
-        return self.site.is_content(event) or self.site.is_layout(event) or self.site.is_static(event)
-
-    def on_created(self, event):
-        if isfile(event.src_path):
-            if self.site.is_content(event):
-                data = self.site.cache.read(event.src_path)
-                page = Page.parse_string(event.src_path, self.site, data)
-                page.render_to_disk()
-            elif self.site.is_static(event):
-                self.site.copy_static(event.src_path)
-
-    def on_deleted(self, event):
-        if self.is_watched(event.src_path):
-            logging.debug('Deletion detected for %s', event.src_path)
-            shutil.rmtree(event.src_path)
-
-    def on_modified(self, event):
-        if isfile(event.src_path) and self.is_watched(event):
-            path = self.site.relpath(event.src_path)
-            logging.debug('Change detected for %s', event.src_path)
-            if self.site.is_content(event):
-                if self.site.cache.get(path) != self.site.cache.read(path):
-                    data = self.site.cache.get(path)
-                    page = Page.parse_string(path, self.site, data)
-                    page.render_to_disk()
-                    self.site.render_dependents(relpath(self.site.relpath(event.src_path), 'content'))
-            elif self.site.is_static(event):
-                self.site.copy_static(event.src_path)
-            elif self.site.is_layout(event):
-                if self.site.cache.get(path) != self.site.cache.read(path):
-                    self.site.render_dependents(relpath(self.site.relpath(event.src_path), 'layouts'))
-
-    def on_moved(self, event):
-        if isfile(event.dest_path) and self.is_watched(event):
-            self.on_deleted(event)
-            # This is a hack and probably has some bad consequence I'm not
-            # thinking about right now.
-            event.src_path = event.dest_path
-            self.on_created(event)
+        have created here, and on files the site ignores, like swap files.
+        """
+        if self.site.ignore.ignores(self.site.relpath(path)):
+            return False
+        return self.site.is_content(path) or self.site.is_layout(path) or self.site.is_static(path)
+
+    def dispatch(self, event):
+        # Folders are reported as modified whenever a file in them changes, and
+        # we hear about the file itself anyway
+        if event.event_type not in self.event_types or (event.is_directory and event.event_type == 'modified'):
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path and self.is_watched(path):
+                self.queue.add(self.site.relpath(path))
 
 
 class Watcher:
-    def __init__(self, site):
+    folders = ['content', 'layouts', 'static']
+
+    def __init__(self, site, events=None, window=0.1):
+        """
+        Keyword Arguments:
+        events -- A queue that receives a list of changed URLs after each
+                change we handle, for the preview server's live reload.
+        window -- Changes that arrive within this many seconds of each other
+                are rebuilt together.
+        """
         self.site = site
+        self.queue = ChangeQueue(window)
         Handler.site = site
+        Handler.queue = self.queue
+        if events is not None:
+            site.listeners.append(events.put)
+
+    def rebuild(self, paths):
+        """Apply a batch of changes and tell the preview server about them"""
+        logging.debug('Rebuilding %d changed paths', len(paths))
+        if self.site.profiler is not None:
+            self.site.profiler.reset()
+        try:
+            self.site.apply_changes(paths)
+        except Exception as e:
+            # Keep watching; the next save will probably fix it
+            logging.exception('Rebuild failed')
+            ui('ERROR: %s' % e)
+        if self.site.profiler is not None:
+            ui(self.site.profiler.format_report())
+        self.site.publish()
+
+    def process(self):
+        while True:
+            self.rebuild(self.queue.get())
 
-    def watch(self):
+    def start(self):
+        """
+        Start watching in a background thread and return the observer, so
+        the caller can do something else (like serving) in this process
+        """
+        self.site.cache_templates()
+        import watchdog.observers
         obs = watchdog.observers.Observer()
-        obs.schedule(Handler(), join(self.site.root), recursive=True)
+        handler = Handler()
+        # Only watch the source folders so writing output doesn't wake us up
+        for folder in self.folders:
+            if isdir(join(self.site.root, folder)):
+                obs.schedule(handler, join(self.site.root, folder), recursive=True)
         logging.debug('Watching for changes in %s' % self.site.root)
         ui('Watching for changes in %s' % self.site.root)
         obs.start()
+        processor = threading.Thread(target=self.process)
+        processor.daemon = True
+        processor.start()
+        return obs
+
+    def watch(self):
+        obs = self.start()
         try:
             while True:
                 time.sleep(1)
@@ -611,61 +2855,86 @@ class Watcher:
         obs.join()
 
 
-class HTTPHandler(SimpleHTTPRequestHandler):
-    site = None
+def guess_type(path):
+    """
+    Guess the content type for a file we're serving. Text formats we generate
+    are always utf-8.
+    """
+    base, ext = posixpath.splitext(path)
+    if ext == '.html':
+        return 'text/html; charset=utf-8'
+    if ext == '.css':
+        return 'text/css; charset=utf-8'
+    if ext == '.js':
+        return 'text/javascript; charset=utf-8'
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
 
-    def guess_type(self, path):
-        base, ext = posixpath.splitext(path)
-        if ext == '.html':
-            return 'text/html; charset=utf-8'
-        if ext == '.css':
-            return 'text/css; charset=utf-8'
-        if ext == '.js':
-            return 'text/javascript; charset=utf-8'
-        if platform.python_version_tuple()[0] == '2':
-            return SimpleHTTPRequestHandler.guess_type(self, path)
-        else:
-            return super().guess_type(path)
 
+def output_url(target):
+    """
+    Get the URL for a path relative to the output folder. index.html is
+    served for its folder so we use the folder URL instead.
+    """
+    url = '/' + target.replace(os.sep, '/')
+    if posixpath.basename(url) == 'index.html':
+        url = url[:-len('index.html')]
+    return url
 
-    def translate_path(self, path):
-        if platform.python_version_tuple()[0] == '2':
-            path = SimpleHTTPRequestHandler.translate_path(self, path)
-        else:
-            path = super().translate_path(path)
-        # Since we are serving from the project root instead of content root
-        # we want to insert 'content' into the filepath.
-        path = abspath(join('output', relpath(path)))
-        return path
-
-    def log_request(self, code='-', size='-'):
-        # Don't log HEAD requests because these are very spammy with livejs turned on
-        if self.command == 'HEAD':
-            return
-        if platform.python_version_tuple()[0] == '2':
-            SimpleHTTPRequestHandler.log_request(self, code, size)
-        else:
-            super().log_request(code, size)
+
+def livereload_script():
+    """
+    The live reload client with Live.js embedded as its fallback, for
+    injecting into pages in preview mode
+    """
+    return livereload.replace('LIVEJS', json.dumps(livejs).replace('</', '<\\/'))
 
 
-class HTTPServer(TCPServer):
-    def server_activate(self):
-        ui('Server started successfully')
-        logging.debug('Listening on http://%s:%s/' % self.server_address)
-        if platform.python_version_tuple()[0] == '2':
-            TCPServer.server_activate(self)
-        else:
-            super().server_activate()
+def translate_path(root, path):
+    """
+    Map a URL path to a file in the site's output folder. This works the same
+    way as SimpleHTTPRequestHandler.translate_path, so query strings are
+    dropped and .. can't escape the output folder.
+    """
+    path = path.split('?', 1)[0]
+    path = path.split('#', 1)[0]
+    trailing_slash = path.rstrip().endswith('/')
+    path = posixpath.normpath(unquote(path))
+    filename = join(root, 'output')
+    for word in path.split('/'):
+        if not word or dirname(word) or word in (os.curdir, os.pardir):
+            continue
+        filename = join(filename, word)
+    if trailing_slash:
+        filename += '/'
+    return filename
 
 
 class Server:
-    def __init__(self, site):
+    def __init__(self, site, events=None):
+        """
+        Keyword Arguments:
+        events -- A queue of changed URLs from a Watcher. The server pushes
+                these to the browser so pages reload as soon as they change.
+        """
         self.site = site
+        self.events = events
 
     def serve(self, address, port):
-        HTTPHandler.site = self.site
         ui('Starting server on http://%s:%s/' % (address, port))
         ui('HEAD requests are omitted from the logs')
+        if sys.version_info < (3, 7):
+            self.serve_legacy(address, port)
+        else:
+            from .server import AsyncServer
+            AsyncServer(self.site, self.events).serve(address, port)
+
+    def serve_legacy(self, address, port):
+        """
+        Serve with the single-threaded TCPServer, which is all we have before
+        Python 3.7
+        """
+        from .legacy import HTTPHandler, HTTPServer
+        HTTPHandler.site = self.site
         httpd = None
         while True:
             try:
@@ -703,29 +2972,83 @@ def init(debug, f, path):
 
 @cli.command()
 @click.option("--debug/--no-debug", default=False)
-def build(debug):
+@click.option("--full/--incremental", default=False,
+              help="Clean the output folder and render every page, ignoring the build manifest")
+@click.option("--jobs", "-j", default=None, type=int,
+              help="Number of processes used to render pages (default 1) and compress output (default one per CPU)")
+@click.option("--checksum/--no-checksum", default=False,
+              help="Compare static files by hash instead of size and modification time")
+@click.option("--link/--no-link", default=False, help="Hard link static files into output instead of copying")
+@click.option("--markdown", default=MarkdownEngine.name, type=click.Choice(sorted(markdown_engines)),
+              help="Engine used to convert markdown")
+@click.option("--compress/--no-compress", default=False,
+              help="Also write .gz (and .br, with brotli installed) versions of output files")
+@click.option("--fingerprint/--no-fingerprint", default=False,
+              help="Give static assets names that include a hash of their content")
+@click.option("--profile/--no-profile", default=False, help="Report where the build spent its time")
+@click.option("--profile-output", type=click.Path(), help="Write the profile to this JSON file")
+@click.option("--profile-trace", type=click.Path(), help="Write a Chrome trace (chrome://tracing) to this file")
+def build(debug, full, jobs, checksum, link, markdown, compress, fingerprint, profile, profile_output,
+          profile_trace):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    Site(curdir).build()
+    profiler = None
+    if profile or profile_output or profile_trace:
+        profiler = Profiler()
+        profiler.install()
+        if jobs is not None and jobs > 1:
+            click.echo('Profiling renders pages in this process; ignoring --jobs')
+            jobs = 1
+    try:
+        site = Site(curdir, markdown_engine=markdown, profiler=profiler, fingerprint=fingerprint)
+        site.build(full=full, jobs=jobs, checksum=checksum, link=link, compress=compress)
+    finally:
+        if profiler is not None:
+            profiler.uninstall()
+    if profiler is not None:
+        save_profile(profiler, profile_output, profile_trace)
+        click.echo(profiler.format_report())
+
+
+def save_profile(profiler, output=None, trace=None):
+    if output:
+        with open(output, 'w') as f:
+            json.dump(profiler.report(), f, indent=2)
+    if trace:
+        with open(trace, 'w') as f:
+            json.dump(profiler.trace(), f)
 
 
 @cli.command()
 @click.option("--debug/--no-debug", default=False)
 @click.option("--address", '-a', default="127.0.0.1", type=str)
 @click.option("--port", '-p', default=8000, type=int)
-def preview(debug, address, port):
+@click.option("--markdown", default=MarkdownEngine.name, type=click.Choice(sorted(markdown_engines)),
+              help="Engine used to convert markdown")
+@click.option("--memory/--disk", default=False,
+              help="Watch and serve in one process, serving pages from memory instead of output")
+@click.option("--write/--no-write", default=False, help="With --memory, also write pages to output")
+@click.option("--debounce", default=0.1, type=float,
+              help="Seconds to wait for more changes before rebuilding")
+def preview(debug, address, port, markdown, memory, write, debounce):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
-    site = Site(curdir, preview_mode=True)
+    if memory:
+        preview_memory(address, port, markdown, write, debounce)
+        return
+
+    from multiprocessing import Process, Queue
+    site = Site(curdir, preview_mode=True, markdown_engine=markdown)
     site.build()
 
-    watcher = Watcher(site)
+    events = Queue()
+    watcher = Watcher(site, events, window=debounce)
     watcher_pid = Process(target=watcher.watch)
     watcher_pid.daemon = False
     watcher_pid.start()
 
-    server = Server(site)
+    server = Server(site, events)
     server_pid = Process(target=server.serve, args=(address, port))
     server_pid.daemon = False
     server_pid.start()
@@ -736,12 +3059,77 @@ def preview(debug, address, port):
     server_pid.join()
 
 
+def preview_memory(address, port, markdown, write, debounce):
+    """
+    Preview with the watcher and server sharing one process and one store of
+    rendered pages, so changes are visible without a trip through the disk
+    """
+    if platform.python_version_tuple()[0] == '2':
+        raise click.UsageError('--memory requires Python 3')
+    site = Site(curdir, preview_mode=True, markdown_engine=markdown,
+                store=OutputStore(), write_output=write)
+    if write:
+        site.build()
+    site.fill_store()
+
+    observer = Watcher(site, window=debounce).start()
+    click.echo('Use Ctrl-C to quit')
+    try:
+        Server(site).serve(address, port)
+    finally:
+        observer.stop()
+        observer.join()
+
+
 @cli.command()
 @click.option("--debug/--no-debug", default=False)
-def watch(debug):
+@click.option("--markdown", default=MarkdownEngine.name, type=click.Choice(sorted(markdown_engines)),
+              help="Engine used to convert markdown")
+@click.option("--debounce", default=0.1, type=float,
+              help="Seconds to wait for more changes before rebuilding")
+@click.option("--profile/--no-profile", default=False, help="Report where each rebuild spent its time")
+def watch(debug, markdown, debounce, profile):
     if debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    Watcher(Site(curdir, preview_mode=True)).watch()
+    profiler = None
+    if profile:
+        profiler = Profiler()
+        profiler.install()
+    Watcher(Site(curdir, preview_mode=True, markdown_engine=markdown, profiler=profiler), window=debounce).watch()
+
+
+@cli.command(help="""
+    Benchmark icecake against a generated site and print the timings. Use
+    --output to save them as JSON and --baseline to compare with a saved run.
+    """)
+@click.option("--debug/--no-debug", default=False)
+@click.option("--pages", default=200, type=int, help="Number of generated articles")
+@click.option("--tags", default=20, type=int, help="Number of distinct tags")
+@click.option("--layout-depth", default=2, type=int, help="Number of nested layouts used by articles")
+@click.option("--code-blocks", default=1, type=int, help="Highlighted code blocks per article")
+@click.option("--static-files", default=20, type=int, help="Number of extra static files")
+@click.option("--static-size", default=4096, type=int, help="Size of each static file in bytes")
+@click.option("--repeat", default=3, type=int, help="Number of times to run each step")
+@click.option("--jobs", "-j", default=1, type=int, help="Number of processes used to render pages")
+@click.option("--markdown", default=MarkdownEngine.name, type=click.Choice(sorted(markdown_engines)),
+              help="Engine used to convert markdown")
+@click.option("--output", "-o", type=click.Path(), help="Write the results to this JSON file")
+@click.option("--baseline", type=click.Path(exists=True), help="Compare with results saved by --output")
+@click.option("--threshold", default=0.1, type=float, help="Slowdown (as a fraction) reported as a regression")
+def bench(debug, pages, tags, layout_depth, code_blocks, static_files, static_size, repeat, jobs, markdown,
+          output, baseline, threshold):
+    if debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    from . import bench
+    report = bench.run(repeat=repeat, jobs=jobs, markdown_engine=markdown, pages=pages, tags=tags,
+                       layout_depth=layout_depth, code_blocks=code_blocks, static_files=static_files,
+                       static_size=static_size)
+    comparison = bench.compare(report, bench.load(baseline), threshold) if baseline else None
+    click.echo(bench.format_report(report, comparison))
+    if output:
+        bench.save(report, output)
+    if comparison and any(regressed for _, _, _, _, regressed in comparison):
+        exit(1)
 
 
 @cli.command()
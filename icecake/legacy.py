@@ -0,0 +1,51 @@
+# -*- coding: utf8 -*-
+"""
+The single-threaded TCPServer preview server, used before Python 3.7 where
+we don't have what the asyncio server needs. This lives in its own module so the CLI doesn't import
+the http.server machinery unless we're actually going to serve with it.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import logging
+from os.path import abspath
+import platform
+
+from . import cli
+if platform.python_version_tuple()[0] == '2':
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from SocketServer import TCPServer
+else:
+    from http.server import SimpleHTTPRequestHandler
+    from socketserver import TCPServer
+
+__metaclass__ = type
+
+
+class HTTPHandler(SimpleHTTPRequestHandler):
+    site = None
+
+    def guess_type(self, path):
+        return cli.guess_type(path)
+
+    def translate_path(self, path):
+        # Since we are serving from the project root instead of output root
+        # we want to insert 'output' into the filepath.
+        return abspath(cli.translate_path(self.site.root, path))
+
+    def log_request(self, code='-', size='-'):
+        # Don't log HEAD requests because these are very spammy with livejs turned on
+        if self.command == 'HEAD':
+            return
+        if platform.python_version_tuple()[0] == '2':
+            SimpleHTTPRequestHandler.log_request(self, code, size)
+        else:
+            super().log_request(code, size)
+
+
+class HTTPServer(TCPServer):
+    def server_activate(self):
+        cli.ui('Server started successfully')
+        logging.debug('Listening on http://%s:%s/' % self.server_address)
+        if platform.python_version_tuple()[0] == '2':
+            TCPServer.server_activate(self)
+        else:
+            super().server_activate()
@@ -0,0 +1,81 @@
+livereload = '''
+/*
+  Icecake live reload
+
+  Listens for change events from the preview server and reloads only what
+  changed: stylesheets and images are swapped in place, and the page is
+  reloaded if it (or one of its scripts) changed. If the server can't send
+  events we fall back to polling with Live.js.
+*/
+(function () {
+  var fallback = LIVEJS;
+
+  function useLiveJs() {
+    if (window.liveJsLoaded) return;
+    var script = document.createElement("script");
+    script.text = fallback;
+    document.body.appendChild(script);
+  }
+
+  function pathOf(url) {
+    var a = document.createElement("a");
+    a.href = url;
+    var path = a.pathname.charAt(0) == "/" ? a.pathname : "/" + a.pathname;
+    return path.replace(/index\\.html$/, "");
+  }
+
+  function bust(url) {
+    return url.replace(/([?&])livereload=\\d+&?/, "$1").replace(/[?&]$/, "") +
+      (url.indexOf("?") == -1 ? "?" : "&") + "livereload=" + new Date().getTime();
+  }
+
+  function swapStylesheet(link) {
+    var clone = link.cloneNode();
+    clone.href = bust(link.href);
+    clone.onload = function () { link.parentNode && link.parentNode.removeChild(link); };
+    link.parentNode.insertBefore(clone, link.nextSibling);
+  }
+
+  function changed(paths) {
+    var changes = {}, i;
+    for (i = 0; i < paths.length; i++) changes[pathOf(paths[i])] = true;
+
+    if (changes[pathOf(document.location.href)]) return document.location.reload();
+    var scripts = document.getElementsByTagName("script");
+    for (i = 0; i < scripts.length; i++) {
+      if (scripts[i].src && changes[pathOf(scripts[i].src)]) return document.location.reload();
+    }
+    var links = document.getElementsByTagName("link");
+    for (i = 0; i < links.length; i++) {
+      if (links[i].rel.toLowerCase() == "stylesheet" && changes[pathOf(links[i].href)]) swapStylesheet(links[i]);
+    }
+    var images = document.getElementsByTagName("img");
+    for (i = 0; i < images.length; i++) {
+      if (changes[pathOf(images[i].src)]) images[i].src = bust(images[i].src);
+    }
+  }
+
+  if (!window.EventSource || document.location.protocol == "file:") return useLiveJs();
+
+  var opened = false;
+  var source = new EventSource("/__icecake/events");
+  source.onopen = function () { opened = true; };
+  source.onerror = function () {
+    // The server doesn't support events, so poll instead
+    if (!opened) {
+      source.close();
+      useLiveJs();
+    }
+  };
+  source.addEventListener("hello", function (event) {
+    // The server is up but nothing will tell it about changes
+    if (!JSON.parse(event.data).live) {
+      source.close();
+      useLiveJs();
+    }
+  });
+  source.addEventListener("change", function (event) {
+    changed(JSON.parse(event.data));
+  });
+})();
+'''
@@ -0,0 +1,323 @@
+# -*- coding: utf8 -*-
+"""
+An asyncio HTTP server for previewing a site. Unlike TCPServer it handles many
+clients at once and keeps connections open between requests (HTTP/1.1
+keep-alive), so livejs polling from several browser tabs doesn't stall page
+loads. It also pushes change events to the live reload script over
+server-sent events. This module requires Python 3.7.
+"""
+import asyncio
+from email.utils import formatdate, parsedate_to_datetime
+import json
+import logging
+import os
+from os.path import isdir, isfile
+import sys
+import threading
+import time
+
+from . import cli
+
+
+class Request:
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+
+    def keep_alive(self):
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    def accepts(self, encoding):
+        """Whether the client accepts a Content-Encoding, going by Accept-Encoding"""
+        accepted = {}
+        for item in self.headers.get('accept-encoding', '').split(','):
+            name, _, params = item.partition(';')
+            quality = 1.0
+            for param in params.split(';'):
+                key, _, value = param.partition('=')
+                if key.strip() == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[name.strip().lower()] = quality
+        return accepted.get(encoding, accepted.get('*', 0.0)) > 0
+
+
+class Response:
+    def __init__(self, status, reason, headers=None, body=b'', filename=None):
+        self.status = status
+        self.reason = reason
+        self.headers = headers or []
+        self.body = body
+        self.filename = filename  # Send this file after the headers
+
+
+class AsyncServer:
+    """
+    Serves the output folder of a site. Paths are mapped to files and content
+    types the same way as HTTPHandler.
+
+    If events is given it should be a queue of lists of changed URLs (see
+    Site.publish); each list is forwarded to every browser connected to
+    events_path.
+
+    If the site has an OutputStore we serve from that instead of the output
+    folder. The site is rendering in this process, so we publish its changes
+    directly.
+    """
+    max_header_size = 65536
+    events_path = '/__icecake/events'
+    heartbeat = 15
+
+    def __init__(self, site, events=None):
+        self.site = site
+        self.events = events
+        self.clients = set()
+        self.loop = None
+        self.live = events is not None
+        if site.store is not None:
+            site.listeners.append(self.publish)
+            self.live = True
+
+    def publish(self, urls):
+        """Send a change event to every connected client. Thread-safe."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast, list(urls))
+
+    def broadcast(self, urls):
+        for client in self.clients:
+            client.put_nowait(urls)
+
+    def relay(self):
+        """Forward changes from the events queue until it's closed"""
+        while True:
+            try:
+                urls = self.events.get()
+            except (EOFError, OSError):
+                return
+            self.publish(urls)
+
+    async def stream_events(self, writer, request):
+        """Hold the connection open and write an event for each change"""
+        writer.write(('HTTP/1.1 200 OK\r\n'
+                      'Server: icecake\r\n'
+                      'Content-Type: text/event-stream\r\n'
+                      'Cache-Control: no-cache\r\n'
+                      'Connection: close\r\n\r\n').encode('latin-1'))
+        if request.method == 'HEAD':
+            await writer.drain()
+            return
+        # Tell the client whether anyone will send changes; if not it falls
+        # back to polling
+        writer.write(('event: hello\ndata: %s\n\n' % json.dumps({'live': self.live})).encode('utf-8'))
+        await writer.drain()
+        queue = asyncio.Queue()
+        self.clients.add(queue)
+        try:
+            while True:
+                try:
+                    urls = await asyncio.wait_for(queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    # A comment line, so we notice closed connections
+                    writer.write(b': ping\n\n')
+                else:
+                    writer.write(('event: change\ndata: %s\n\n' % json.dumps(urls)).encode('utf-8'))
+                await writer.drain()
+        finally:
+            self.clients.discard(queue)
+
+    async def read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, path, version = line.decode('latin-1').split()
+        except ValueError:
+            raise ValueError('Malformed request line %r' % line)
+        headers = {}
+        size = len(line)
+        while True:
+            line = await reader.readline()
+            size += len(line)
+            if size > self.max_header_size:
+                raise ValueError('Request headers too large')
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        # We don't accept bodies, but make sure we don't mistake one for the
+        # next request
+        length = int(headers.get('content-length', 0) or 0)
+        if length:
+            await reader.readexactly(length)
+        return Request(method, path, version, headers)
+
+    def respond(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return self.error(501, 'Not Implemented')
+        if self.site.store is not None:
+            return self.store_response(request)
+        filename = cli.translate_path(self.site.root, request.path)
+        if isdir(filename):
+            url = request.path.split('?', 1)[0].split('#', 1)[0]
+            if not url.endswith('/'):
+                return Response(301, 'Moved Permanently', [('Location', url + '/'), ('Content-Length', '0')])
+            filename = os.path.join(filename, 'index.html')
+        if not isfile(filename):
+            return self.error(404, 'File not found')
+        return self.file_response(request, filename)
+
+    def store_response(self, request):
+        entry = self.site.store.get(request.path)
+        if entry is None:
+            url = request.path.split('?', 1)[0].split('#', 1)[0]
+            if not url.endswith('/') and self.site.store.get(url + '/') is not None:
+                return Response(301, 'Moved Permanently', [('Location', url + '/'), ('Content-Length', '0')])
+            return self.error(404, 'File not found')
+        if entry.source is not None:
+            if not isfile(entry.source):
+                return self.error(404, 'File not found')
+            return self.file_response(request, entry.source)
+        headers = [
+            ('Content-Type', cli.guess_type(entry.target)),
+            ('Last-Modified', formatdate(entry.modified, usegmt=True)),
+            ('ETag', '"%s"' % entry.etag),
+        ]
+        if request.headers.get('if-none-match') == '"%s"' % entry.etag:
+            return Response(304, 'Not Modified', headers)
+        headers.append(('Content-Length', str(len(entry.body))))
+        return Response(200, 'OK', headers, entry.body)
+
+    # Content-Encoding and the suffix of the precompressed file, best first
+    encodings = [('br', 'br'), ('gzip', 'gz')]
+
+    def precompressed(self, request, filename):
+        """
+        Find a precompressed version of filename (see cli.Precompressor) that
+        the client accepts and that is at least as new as filename. Returns
+        the file and its encoding, and whether there are any versions at all.
+        """
+        variants = False
+        stat = None
+        for encoding, suffix in self.encodings:
+            candidate = '%s.%s' % (filename, suffix)
+            if not isfile(candidate):
+                continue
+            variants = True
+            if not request.accepts(encoding):
+                continue
+            stat = stat or os.stat(filename)
+            if os.stat(candidate).st_mtime >= stat.st_mtime:
+                return candidate, encoding, variants
+        return filename, None, variants
+
+    def file_response(self, request, filename):
+        content_type = cli.guess_type(filename)
+        filename, encoding, variants = self.precompressed(request, filename)
+        stat = os.stat(filename)
+        headers = [
+            ('Content-Type', content_type),
+            ('Last-Modified', formatdate(stat.st_mtime, usegmt=True)),
+            ('ETag', '"%x-%x"' % (int(stat.st_mtime * 1000000), stat.st_size)),
+        ]
+        if encoding is not None:
+            headers.append(('Content-Encoding', encoding))
+        if variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        since = request.headers.get('if-modified-since')
+        if since:
+            try:
+                if int(stat.st_mtime) <= parsedate_to_datetime(since).timestamp():
+                    return Response(304, 'Not Modified', headers)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                pass
+        headers.append(('Content-Length', str(stat.st_size)))
+        return Response(200, 'OK', headers, filename=filename)
+
+    def error(self, status, reason):
+        body = ('<html><body><h1>%d %s</h1></body></html>\n' % (status, reason)).encode('utf-8')
+        return Response(status, reason, [('Content-Type', 'text/html; charset=utf-8'),
+                                         ('Content-Length', str(len(body)))], body)
+
+    async def send(self, writer, request, response, keep_alive):
+        lines = ['%s %d %s' % (request.version if request.version == 'HTTP/1.0' else 'HTTP/1.1',
+                               response.status, response.reason),
+                 'Server: icecake',
+                 'Date: %s' % formatdate(usegmt=True),
+                 'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+        lines.extend('%s: %s' % header for header in response.headers)
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if request.method != 'HEAD':
+            if response.filename is not None:
+                with open(response.filename, 'rb') as f:
+                    await writer.drain()
+                    try:
+                        await asyncio.get_running_loop().sendfile(writer.transport, f)
+                    except (NotImplementedError, RuntimeError):
+                        writer.write(f.read())
+            else:
+                writer.write(response.body)
+        await writer.drain()
+
+    def log(self, request, response, peer):
+        # Don't log HEAD requests because these are very spammy with livejs turned on
+        if request.method == 'HEAD':
+            return
+        sys.stderr.write('%s - - [%s] "%s %s %s" %d -\n' % (
+            peer[0] if peer else '-', time.strftime('%d/%b/%Y %H:%M:%S'),
+            request.method, request.path, request.version, response.status))
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except ValueError as e:
+                    logging.debug('Bad request from %s: %s', peer, e)
+                    break
+                if request is None:
+                    break
+                if request.path.split('?', 1)[0] == self.events_path:
+                    await self.stream_events(writer, request)
+                    break
+                response = self.respond(request)
+                keep_alive = request.keep_alive()
+                await self.send(writer, request, response, keep_alive)
+                self.log(request, response, peer)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, address, port):
+        server = await asyncio.start_server(self.handle, address, port)
+        self.loop = asyncio.get_running_loop()
+        if self.events is not None:
+            threading.Thread(target=self.relay, daemon=True).start()
+        cli.ui('Server started successfully')
+        logging.debug('Listening on http://%s:%s/' % (address, port))
+        return server
+
+    async def run(self, address, port):
+        server = await self.start(address, port)
+        async with server:
+            await server.serve_forever()
+
+    def serve(self, address, port):
+        while True:
+            try:
+                asyncio.run(self.run(address, port))
+            except OSError:
+                cli.ui('ERROR: Listen socket is busy; will retry in 5 seconds')
+                time.sleep(5)
+            except KeyboardInterrupt:
+                break
@@ -112,8 +112,8 @@ u"""{% extends "basic.html" %}
 u"""<!DOCTYPE html>
 <head>
   <title>{% block title %}{{ title }} :: My Site.com{% endblock %}</title>
-  <link href="/css/main.css" rel="stylesheet" />
-  <link href="/css/syntax.css" rel="stylesheet" />
+  <link href="{{ asset_url('css/main.css') }}" rel="stylesheet" />
+  <link href="{{ asset_url('css/syntax.css') }}" rel="stylesheet" />
   <link href="/atom.xml" rel="alternate" type="application/atom+xml" title="My Site" />
   <link href="//fonts.googleapis.com/css?family=Domine:400,700" rel="stylesheet" type="text/css" />
 </head>
@@ -18,7 +18,6 @@ setup(
         'Pygments',
         'python-dateutil',
         'watchdog',
-        'Werkzeug',
     ],
 
     # pypy stuff that is not likely to change between versions
@@ -1,9 +1,12 @@
 import codecs
+import os
 import pytest
+import sys
+import time
 from icecake import cli
 from icecake.templates import templates
 import jinja2
-from os.path import abspath, dirname, isdir, isfile, join
+from os.path import abspath, basename, dirname, exists, isdir, isfile, join
 
 
 module_root = dirname(dirname(abspath(__file__)))
@@ -21,6 +24,42 @@ class TestFunctions:
         ]
 
 
+class TestIgnoreRules:
+    def test_ignores(self):
+        rules = cli.IgnoreRules(['drafts/', 'content/secret.md', '*.bak'])
+        assert rules.ignores('content/.git/config')
+        assert rules.ignores('.git', is_dir=True)
+        assert rules.ignores('content/.post.md.swp')
+        assert rules.ignores('layouts/basic.html~')
+        assert rules.ignores('content/drafts/post.md')
+        assert rules.ignores('content/drafts', is_dir=True)
+        assert not rules.ignores('content/drafts')
+        assert rules.ignores('content/secret.md')
+        assert not rules.ignores('content/articles/secret.md')
+        assert rules.ignores('static/logo.png.bak')
+        assert not rules.ignores('content/index.html')
+
+    def test_scan(self, tmpdir):
+        tmpdir.join('b', 'c.txt').write('c', ensure=True)
+        tmpdir.join('a.txt').write('a')
+        tmpdir.join('.git', 'HEAD').write('ref', ensure=True)
+        assert sorted(cli.scan(tmpdir.strpath)) == [join('.git', 'HEAD'), 'a.txt', join('b', 'c.txt')]
+        assert list(cli.scan(tmpdir.strpath, ignore=cli.IgnoreRules())) == ['a.txt', join('b', 'c.txt')]
+        assert list(cli.scan(tmpdir.strpath, 'b')) == ['c.txt']
+        assert list(cli.scan(tmpdir.strpath, 'nope')) == []
+
+    @pytest.mark.skipif(not hasattr(os, 'symlink'), reason="Needs symlinks")
+    def test_scan_symlink_loop(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        os.symlink('..', join(site.root, 'static', 'css', 'loop'))
+        os.symlink('main.css', join(site.root, 'static', 'css', 'link.css'))
+        # Links to folders are skipped like os.walk does; links to files aren't
+        assert sorted(cli.scan(site.root, 'static')) == [join('css', 'link.css'), join('css', 'main.css'),
+                                                         join('css', 'syntax.css')]
+        cli.Site(site.root).build()
+        assert isfile(join(site.root, 'output', 'css', 'link.css'))
+
+
 class TestContentCache:
     def test_read(self):
         cache = cli.ContentCache(join(module_root, 'templates'))
@@ -39,6 +78,85 @@ class TestContentCache:
         # Read missing file
         assert cache.read('layouts/nope.html') is None
 
+    def test_warm_ignores(self, tmpdir):
+        cli.Site.initialize(tmpdir.strpath)
+        tmpdir.join('content', '.index.html.swp').write('swap')
+        tmpdir.join('content', 'drafts', 'idea.md').write('idea', ensure=True)
+        tmpdir.join('content', '.git', 'HEAD').write('ref', ensure=True)
+        tmpdir.join('.icecakeignore').write('# Not ready yet\ncontent/drafts/\n')
+        site = cli.Site(tmpdir.strpath)
+        assert site.cache.get('content/index.html') is not None
+        assert site.cache.get('content/.index.html.swp') is None
+        assert site.cache.get('content/drafts/idea.md') is None
+        assert site.cache.get('content/.git/HEAD') is None
+        assert sorted(site.pagedata) == ['articles.html', 'articles/hello-world.md', 'atom.xml',
+                                         'index.html', 'tags.html']
+
+    def test_budget(self, tmpdir):
+        cli.Site.initialize(tmpdir.strpath)
+        for i in range(10):
+            tmpdir.join('content', 'post-%d.md' % i).write('x' * 100)
+        cache = cli.ContentCache(tmpdir.strpath, budget=500)
+        cache.warm()
+        assert cache.used <= 500
+        assert len([file for file in cache.files if cache.files[file] is None]) > 0
+
+        # Templates are never evicted
+        assert set(cache.templates) == set(['articles.html', 'atom.xml', 'index.html', 'tags.html',
+                                            'basic.html', 'markdown.html'])
+
+        # Evicted pages are read again when we need them
+        for i in range(10):
+            assert cache.get('content/post-%d.md' % i) == 'x' * 100
+            assert cache.used <= 500
+
+    def test_refresh(self, tmpdir, monkeypatch):
+        cli.Site.initialize(tmpdir.strpath)
+        cache = cli.ContentCache(tmpdir.strpath)
+        cache.warm()
+        path = 'content/articles/hello-world.md'
+        assert cache.is_fresh(path)
+
+        # Unchanged files are checked with stat instead of being read
+        load = cache.load
+        monkeypatch.setattr(cache, 'load', lambda filename: pytest.fail('read %s' % filename))
+        assert not cache.refresh(path)
+        monkeypatch.setattr(cache, 'load', load)
+
+        tmpdir.join(path).write('title = Changed\n++++\nNew words')
+        assert not cache.is_fresh(path)
+        assert cache.refresh(path)
+        assert cache.get(path) == 'title = Changed\n++++\nNew words'
+        assert not cache.refresh(path)
+
+    def test_refresh_evicted(self, tmpdir):
+        cli.Site.initialize(tmpdir.strpath)
+        for i in range(10):
+            tmpdir.join('content', 'post-%d.md' % i).write('x' * 100)
+        cache = cli.ContentCache(tmpdir.strpath, budget=500)
+        cache.warm()
+        path = [file for file in cache.files if cache.files[file] is None][0]
+
+        # Touching an evicted file doesn't make it changed
+        tmpdir.join(path).setmtime(tmpdir.join(path).mtime() + 10)
+        assert not cache.refresh(path)
+        cache.evict()
+        tmpdir.join(path).write('y' * 100)
+        assert cache.refresh(path)
+
+    def test_parse_while_warming(self, tmpdir, monkeypatch):
+        cli.Site.initialize(tmpdir.strpath)
+        for i in range(10):
+            tmpdir.join('content', 'post-%d.md' % i).write('title = Post %d\n++++\n%s' % (i, 'x' * 100))
+        loads = []
+        load = cli.ContentCache.load
+        monkeypatch.setattr(cli.ContentCache, 'budget', 500)
+        monkeypatch.setattr(cli.ContentCache, 'load', lambda self, file: loads.append(file) or load(self, file))
+        pages = cli.Site(tmpdir.strpath).pagedata
+        assert len(loads) == len(set(loads))
+        assert pages['post-3.md'].title == 'Post 3'
+        assert pages['post-3.md'].body == 'x' * 100
+
     def test_missing(self):
         cache = cli.ContentCache(join(module_root, 'templates'))
         assert cache.get('nope') is None
@@ -68,6 +186,150 @@ class TestContentCache:
         assert cache.get('layouts/basic.html') == basic
 
 
+class TestCacheLoader:
+    def test_load(self):
+        cache = cli.ContentCache(join(module_root, 'templates'))
+        env = jinja2.Environment(loader=cli.CacheLoader(cache))
+        cache.set('layouts/hi.html', 'Hi {{ name }}')
+        template = env.get_template('hi.html')
+        assert template.render(name='cake') == 'Hi cake'
+
+        # Unchanged templates are reused
+        assert env.get_template('hi.html') is template
+
+        # Changed templates are compiled again
+        cache.set('layouts/hi.html', 'Hello {{ name }}')
+        assert env.get_template('hi.html').render(name='cake') == 'Hello cake'
+
+        with pytest.raises(jinja2.TemplateNotFound):
+            env.get_template('nope.html')
+
+    def test_bytecode_cache(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        assert len(cli.ls_relative(join(site.root, '.icecake-cache', 'jinja'))) > 0
+
+
+class TestMarkdownCache:
+    def test_lru(self):
+        cache = cli.MarkdownCache(size=2)
+        cache.set('a', 'A')
+        cache.set('b', 'B')
+        assert cache.get('a') == 'A'
+        cache.set('c', 'C')
+        # b was used least recently so it was evicted
+        assert cache.get('b') is None
+        assert cache.get('a') == 'A'
+        assert cache.get('c') == 'C'
+
+    def test_key(self):
+        cache = cli.MarkdownCache()
+        engine = cli.MarkdownEngine(['fenced_code'], {})
+        key = cache.key('# Hi', engine)
+        assert key == cache.key('# Hi', cli.MarkdownEngine(['fenced_code'], {}))
+        assert key != cache.key('# Hello', engine)
+        assert key != cache.key('# Hi', cli.MarkdownEngine(['fenced_code', 'codehilite'], {}))
+        assert key != cache.key('# Hi', cli.MarkdownEngine(['fenced_code'], {'codehilite': {'linenums': True}}))
+
+    def test_key_versions(self, tmpdir, monkeypatch):
+        import pygments
+        cache = cli.MarkdownCache()
+        engine = cli.MarkdownEngine(['fenced_code', 'codehilite'], {})
+        plain = cli.MarkdownEngine(['fenced_code'], {})
+        site = cli.Site(tmpdir.strpath)
+        key, plain_key, options = cache.key('# Hi', engine), cache.key('# Hi', plain), site.get_options()
+        # Upgrading Pygments changes the HTML of highlighted code
+        monkeypatch.setattr(pygments, '__version__', '0.0.1')
+        assert cache.key('# Hi', engine) != key
+        assert cache.key('# Hi', plain) == plain_key
+        assert site.get_options() != options
+
+    def test_persist(self, tmpdir):
+        cache = cli.MarkdownCache(tmpdir.strpath)
+        cache.set('abcdef', u'<p>\u03a9</p>')
+        assert cli.MarkdownCache(tmpdir.strpath).get('abcdef') == u'<p>\u03a9</p>'
+
+    def test_prune(self, tmpdir):
+        cache = cli.MarkdownCache(tmpdir.strpath, max_bytes=10)
+        cache.set('aaaa', '12345678')
+        cache.set('bbbb', '12345678')
+        os.utime(join(tmpdir.strpath, 'aa', 'aaaa.html'), (1, 1))
+        cache.prune()
+        assert cli.ls_relative(tmpdir.strpath) == ['bb/bbbb.html']
+
+
+class TestHighlightCache:
+    def test_shared(self, tmpdir, monkeypatch):
+        import pygments
+        calls = []
+        highlight = pygments.highlight
+
+        def counted(code, lexer, formatter):
+            calls.append(code)
+            return highlight(code, lexer, formatter)
+        monkeypatch.setattr(pygments, 'highlight', counted)
+
+        site = cli.Site('.')
+        snippet = "```python\nprint('hi')\n```"
+        first = site.convert_markdown("# One\n\n" + snippet)
+        second = site.convert_markdown("# Two\n\n" + snippet)
+        assert len(calls) == 1
+        assert first.replace('One', 'Two') == second
+
+        # The cache is persisted, so another site doesn't highlight it again
+        site.highlight_cache.path = tmpdir.strpath
+        site.convert_markdown("# Three\n\n" + snippet + "\n\n```python\nx = 1\n```")
+        assert len(calls) == 2
+        other = cli.Site('.')
+        other.highlight_cache.path = tmpdir.strpath
+        assert other.convert_markdown("# Four\n\n```python\nx = 1\n```").endswith(
+            site.convert_markdown("```python\nx = 1\n```"))
+        assert len(calls) == 2
+
+    def test_restored(self):
+        import markdown.extensions.codehilite as codehilite
+        highlight = codehilite.highlight
+        cli.Site('.').convert_markdown("```python\nprint('hi')\n```")
+        assert codehilite.highlight is highlight
+        with cli.installed_highlighter():
+            with cli.installed_highlighter():
+                assert codehilite.highlight is cli.highlight
+            assert codehilite.highlight is cli.highlight
+        assert codehilite.highlight is highlight
+        assert codehilite.get_lexer_by_name is not cli.get_lexer
+
+    def test_reuse(self):
+        assert cli.get_lexer('python') is cli.get_lexer('python')
+        assert cli.get_lexer('python') is not cli.get_lexer('python', stripnl=False)
+        assert cli.get_formatter('html', nowrap=True) is cli.get_formatter('html', nowrap=True)
+
+
+class TestMarkdownEngine:
+    def test_convert(self):
+        site = cli.Site('.')
+        engine = site.get_markdown_engine()
+        text = "```python\nprint('hi')\n```\n\n# Title"
+        import markdown
+        expected = markdown.markdown(text, extensions=site.markdown_plugins,
+                                     extension_configs=site.markdown_options)
+        # Converting twice with the same converter gives the same result
+        assert engine.convert(text) == expected
+        assert engine.convert(text) == expected
+        assert site.get_markdown_engine() is engine
+
+    def test_commonmark(self):
+        pytest.importorskip('markdown_it')
+        site = cli.Site('.', markdown_engine='commonmark')
+        html = site.convert_markdown("# Title\n\n```python\nprint('hi')\n```")
+        assert html.startswith('<h1>Title</h1>')
+        assert '<pre class="codehilite"><code><span class="nb">print</span>' in html
+
+    def test_unknown(self):
+        site = cli.Site('.', markdown_engine='nope')
+        with pytest.raises(ValueError):
+            site.convert_markdown('# Title')
+
+
 class TestPage:
     def test_init(self):
         site = cli.Site('.')
@@ -102,6 +364,39 @@ template = myfile.html
         assert page.slug == "some-title"
         assert page.template == "myfile.html"
         assert page.url == "/this/file/does/not/some-title/"
+        assert page.published == cli.parse_date("2013-01-02")
+
+    def test_parse_front_matter(self):
+        meta = """Title = 100% Cake
+# A comment
+; Another comment
+date: 2013-01-02
+tags = pie cake
+  chocolate
+slug=cake
+template =
+title = Cake: The Sequel"""
+        assert cli.parse_front_matter(meta) == {
+            'title': 'Cake: The Sequel',
+            'date': '2013-01-02',
+            'tags': 'pie cake\nchocolate',
+            'slug': 'cake',
+            'template': '',
+        }
+        assert cli.parse_front_matter('') == {}
+        assert cli.parse_front_matter('not metadata\ntitle = Cake') == {'title': 'Cake'}
+
+    def test_parse_date(self):
+        utc = cli.parse_date('2013-01-02')
+        assert utc == cli.parse_date('2013-01-02T00:00:00Z')
+        assert utc.tzinfo is not None and utc.utcoffset().total_seconds() == 0
+        assert cli.parse_date('2013-01-02 10:30:15.5-05:00').utcoffset().total_seconds() == -5 * 3600
+        assert cli.parse_date('2013-01-02 10:30:15.5-05:00').microsecond == 500000
+        # Anything else goes through dateutil
+        assert cli.parse_date('January 2, 2013') == utc
+        assert cli.parse_date('2013-01-02') is cli.parse_date('2013-01-02')
+        assert cli.parse_date('2013-13-45') is None
+        assert cli.parse_date('not a date') is None
 
     def test_get_target(self):
         # Test basic case
@@ -210,6 +505,62 @@ class TestSite:
         assert isdir(join(site.root, 'output', 'css'))
         assert isfile(target)
 
+    def test_sync_static(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+
+        copied = []
+        copy_file = cli.copy_file
+        monkeypatch.setattr(cli, 'copy_file', lambda source, target, link=False: (
+            copied.append(source), copy_file(source, target, link)))
+
+        # Nothing changed
+        site.sync_static()
+        assert copied == []
+        site.sync_static(checksum=True)
+        assert copied == []
+
+        # Changed files are copied again
+        with open(join(site.root, 'static', 'css', 'main.css'), 'a') as f:
+            f.write('body { color: red; }\n')
+        site.sync_static()
+        assert copied == [join(site.root, 'static', 'css', 'main.css')]
+        assert open(join(site.root, 'output', 'css', 'main.css')).read().endswith('color: red; }\n')
+
+    def test_sync_static_link(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build(link=True)
+        assert os.path.samefile(join(site.root, 'static', 'css', 'main.css'),
+                                join(site.root, 'output', 'css', 'main.css'))
+
+        # Editing a linked file and picking up the change leaves the source alone
+        source = join(site.root, 'static', 'css', 'main.css')
+        with open(source, 'a') as f:
+            f.write('body { color: red; }\n')
+        cli.Site(site.root, preview_mode=True).apply_changes(['static/css/main.css'])
+        assert open(source).read().endswith('color: red; }\n')
+
+        # and neither does copying over a link
+        cli.copy_file(source, join(site.root, 'output', 'css', 'main.css'))
+        assert open(source).read().endswith('color: red; }\n')
+        output = join(site.root, 'output', 'css', 'syntax.css')
+        cli.copy_file(source, output)
+        assert not os.path.samefile(join(site.root, 'static', 'css', 'syntax.css'), output)
+        assert open(output).read() == open(source).read()
+
+    def test_build_prunes_output(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        os.remove(join(site.root, 'static', 'css', 'syntax.css'))
+        os.makedirs(join(site.root, 'output', 'old'))
+        with open(join(site.root, 'output', 'old', 'page.html'), 'w') as f:
+            f.write('stale')
+        cli.Site(site.root).build()
+        files = cli.ls_relative(join(site.root, 'output'))
+        assert 'css/syntax.css' not in files
+        assert 'css/main.css' in files
+        assert not isdir(join(site.root, 'output', 'old'))
+
     def test_render(self, tmpdir):
         site = cli.Site.initialize(tmpdir.strpath)
         site.get_pages()
@@ -237,6 +588,252 @@ class TestSite:
             'tags/index.html'
         ]
 
+    def test_build_renders_once(self, tmpdir, monkeypatch):
+        rendered = []
+        render = cli.Page.render
+
+        def counting_render(page):
+            rendered.append(page.filepath)
+            return render(page)
+        monkeypatch.setattr(cli.Page, 'render', counting_render)
+
+        site = cli.Site.initialize(tmpdir.strpath)
+        assert rendered == []
+        site.build()
+        assert sorted(rendered) == sorted(site.pagedata.keys())
+
+    def test_build_parallel(self, tmpdir):
+        serial = cli.Site.initialize(tmpdir.join('serial').strpath)
+        serial.build()
+        parallel = cli.Site.initialize(tmpdir.join('parallel').strpath)
+        parallel.build(jobs=2)
+
+        files = cli.ls_relative(join(serial.root, 'output'))
+        assert files == cli.ls_relative(join(parallel.root, 'output'))
+        for file in files:
+            with open(join(serial.root, 'output', file), 'rb') as f:
+                expected = f.read()
+            with open(join(parallel.root, 'output', file), 'rb') as f:
+                assert f.read() == expected
+
+    def test_build_converts_markdown_once(self, tmpdir, monkeypatch):
+        converted = []
+        convert = cli.MarkdownEngine.convert
+
+        def counting_convert(engine, text):
+            converted.append(text)
+            return convert(engine, text)
+        monkeypatch.setattr(cli.MarkdownEngine, 'convert', counting_convert)
+
+        # The article is used by its own page and by the feed
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        assert len(converted) == 1
+
+        # Later builds reuse the conversion from disk
+        cli.Site(site.root).build(jobs=1)
+        site = cli.Site(site.root)
+        site.build()
+        site.pagedata['atom.xml'].render()
+        assert len(converted) == 1
+
+    def test_build_incremental(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        assert isfile(join(site.root, '.icecake-cache', 'manifest.json'))
+
+        # Backdate the outputs so we can see which ones get rewritten
+        article = join(site.root, 'output', 'articles', 'hello-world', 'index.html')
+        listing = join(site.root, 'output', 'articles', 'index.html')
+        for path in [article, listing]:
+            os.utime(path, (1, 1))
+
+        # Nothing changed so nothing should be rendered
+        cli.Site(site.root).build()
+        assert os.stat(article).st_mtime == 1
+        assert os.stat(listing).st_mtime == 1
+
+        # Changing the article re-renders it and the pages that list it
+        source = join(site.root, 'content', 'articles', 'hello-world.md')
+        with codecs.open(source, encoding='utf-8', mode='a') as f:
+            f.write('\nMore cake!\n')
+        cli.Site(site.root).build()
+        assert 'More cake!' in codecs.open(article, encoding='utf-8').read()
+        # The listing was rendered again, but it only shows titles so it came
+        # out the same and wasn't rewritten
+        assert os.stat(listing).st_mtime == 1
+
+        # Outputs modified by hand are put back
+        with codecs.open(article, encoding='utf-8', mode='w') as f:
+            f.write('oops')
+        cli.Site(site.root).build()
+        assert 'More cake!' in codecs.open(article, encoding='utf-8').read()
+
+    def test_build_compress(self, tmpdir):
+        import gzip
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.precompressor.threshold = 100
+        site.build(compress=True)
+        index = join(site.root, 'output', 'index.html')
+        with gzip.open(index + '.gz') as f:
+            assert f.read() == open(index, 'rb').read()
+
+        # Unchanged files aren't compressed again
+        os.utime(index + '.gz', (1, 1))
+        site = cli.Site(site.root)
+        site.precompressor.threshold = 100
+        site.build(compress=True)
+        assert os.stat(index + '.gz').st_mtime == 1
+
+        # Changed files are, and compressed files are removed with their output
+        tmpdir.join('content', 'index.html').write('{% extends "basic.html" %}' + 'cake ' * 100)
+        os.remove(join(site.root, 'content', 'articles', 'hello-world.md'))
+        site = cli.Site(site.root)
+        site.precompressor.threshold = 100
+        site.build(compress=True, jobs=2)
+        assert os.stat(index + '.gz').st_mtime != 1
+        assert not exists(join(site.root, 'output', 'articles', 'hello-world', 'index.html.gz'))
+
+        # Building without compression removes them
+        cli.Site(site.root).build()
+        assert not exists(index + '.gz')
+
+    def test_compress_jobs(self, tmpdir, monkeypatch):
+        import multiprocessing
+        site = cli.Site.initialize(tmpdir.strpath)
+        jobs = []
+        monkeypatch.setattr(site.precompressor, 'run', lambda root, expected, n: jobs.append(n) or ([], 0))
+        site.compress_output(set(), 1)
+        site.compress_output(set())
+        assert jobs == [1, multiprocessing.cpu_count()]
+
+    def test_build_fingerprint(self, tmpdir, monkeypatch):
+        import json
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Site(site.root, fingerprint=True).build()
+        output = join(site.root, 'output')
+        manifest = json.load(open(join(output, 'asset-manifest.json')))
+        main = manifest['css/main.css']
+        assert main.startswith('/css/main.') and main.endswith('.css') and len(main) == len('/css/main..css') + 12
+        assert isfile(output + main)
+        assert not exists(join(output, 'css', 'main.css'))
+        assert main in open(join(output, 'index.html')).read()
+
+        # Assets are only hashed again when their size or mtime changes
+        hashed = []
+        file_digest = cli.file_digest
+        monkeypatch.setattr(cli, 'file_digest', lambda path: hashed.append(path) or file_digest(path))
+        cli.Site(site.root, fingerprint=True).build()
+        assert not [path for path in hashed if '/static/' in path]
+
+        # Changing an asset renames it, and pages that link to it are rebuilt
+        tmpdir.join('static', 'css', 'main.css').write('body { color: pink; }')
+        cli.Site(site.root, fingerprint=True).build()
+        manifest = json.load(open(join(output, 'asset-manifest.json')))
+        assert manifest['css/main.css'] != main
+        assert not exists(output + main)
+        assert manifest['css/main.css'] in open(join(output, 'index.html')).read()
+        assert manifest['css/main.css'] in open(join(output, 'articles', 'hello-world', 'index.html')).read()
+
+        # url()s in stylesheets point at fingerprinted names
+        tmpdir.join('static', 'img', 'cake.png').write('cake', ensure=True)
+        tmpdir.join('static', 'css', 'main.css').write(
+            'body { background: url(../img/cake.png); }\n'
+            'h1 { background: url("/img/cake.png?v=1") }\n'
+            'p { background: url(data:image/png;base64,AAAA) }')
+        cli.Site(site.root, fingerprint=True).build()
+        manifest = json.load(open(join(output, 'asset-manifest.json')))
+        css = open(output + manifest['css/main.css']).read()
+        cake = manifest['img/cake.png']
+        assert isfile(output + cake)
+        assert not exists(join(output, 'img', 'cake.png'))
+        assert 'url(../img/%s)' % basename(cake) in css
+        assert 'url("/img/%s?v=1")' % basename(cake) in css
+        assert 'url(data:image/png;base64,AAAA)' in css
+
+        # so changing the image renames the stylesheet too
+        main = manifest['css/main.css']
+        tmpdir.join('static', 'img', 'cake.png').write('more cake')
+        cli.Site(site.root, fingerprint=True).build()
+        manifest = json.load(open(join(output, 'asset-manifest.json')))
+        assert manifest['css/main.css'] != main
+        assert basename(manifest['img/cake.png']) in open(output + manifest['css/main.css']).read()
+
+        # Turning fingerprinting off puts the plain names back
+        cli.Site(site.root).build()
+        assert isfile(join(output, 'css', 'main.css'))
+        assert not exists(join(output, 'asset-manifest.json'))
+        assert 'href="/css/main.css"' in open(join(output, 'index.html')).read()
+
+    def test_output_writer(self, tmpdir):
+        writer = cli.OutputWriter(tmpdir.strpath)
+        assert writer.write('a/b/index.html', b'cake')
+        path = tmpdir.join('a', 'b', 'index.html')
+        assert path.read() == 'cake'
+        assert oct(path.stat().mode & 0o777) == oct(writer.mode)
+        os.utime(path.strpath, (1, 1))
+
+        # The same content isn't written again, whether or not we know its hash
+        assert not writer.write('a/b/index.html', b'cake')
+        assert not cli.OutputWriter(tmpdir.strpath).write('a/b/index.html', b'cake')
+        assert path.stat().mtime == 1
+
+        # A file that someone else changed is put back
+        path.write('pie!')
+        assert writer.write('a/b/index.html', b'cake')
+        assert path.read() == 'cake'
+        assert writer.write('a/b/index.html', b'pie')
+        assert path.read() == 'pie'
+        assert [file for file in cli.ls_relative(tmpdir.strpath)] == ['a/b/index.html']
+
+        # Folders removed behind our back are created again
+        tmpdir.join('a').remove()
+        assert writer.write('a/b/index.html', b'pie')
+
+    def test_build_removes_stale_outputs(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        os.remove(join(site.root, 'content', 'articles', 'hello-world.md'))
+        cli.Site(site.root).build()
+        assert 'articles/hello-world/index.html' not in cli.ls_relative(join(site.root, 'output'))
+
+    def test_build_full(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        index = join(site.root, 'output', 'index.html')
+        os.utime(index, (1, 1))
+        cli.Site(site.root).build(full=True)
+        assert os.stat(index).st_mtime != 1
+
+    def test_build_profile(self, tmpdir):
+        import pygments
+        cli.Site.initialize(tmpdir.strpath)
+        highlight = pygments.highlight
+        profiler = cli.Profiler()
+        profiler.install()
+        try:
+            cli.Site(tmpdir.strpath, profiler=profiler).build(full=True)
+        finally:
+            profiler.uninstall()
+        assert pygments.highlight is highlight
+
+        report = profiler.report()
+        calls = dict((row['name'], row['calls']) for row in report['phases'])
+        assert calls['cache warm'] == 1
+        assert calls['metadata parse'] == 5
+        assert calls['markdown'] == 1
+        assert calls['pygments'] >= 1
+        assert calls['jinja render'] == 5
+        assert calls['disk write'] == 5
+        assert calls['static copy'] == 2
+        # Phases nest, but each is only counted once
+        assert sum(row['seconds'] for row in report['phases']) <= report['wall']
+        assert 'articles/hello-world.md' in [row['name'] for row in report['pages']]
+        assert not [row['name'] for row in report['pages'] if row['name'].startswith('static')]
+        assert 'markdown.html' in [row['name'] for row in report['templates']]
+        assert len(profiler.trace()['traceEvents']) == sum(calls.values())
+        assert 'slowest pages' in profiler.format_report()
+
     def test_clean_output(self, tmpdir):
         site = cli.Site.initialize(tmpdir.strpath)
         files = cli.ls_relative(site.root)
@@ -251,6 +848,112 @@ class TestSite:
         assert 'output/index.html' not in files
 
 
+class TestQueries:
+    def make_site(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        for i in range(20):
+            meta = 'title = Post %02d\ndate = 2016-01-%02d\ntags = t%d all\n' % (19 - i, i % 5 + 1, i % 3)
+            site.cache.set('content/posts/p%02d.md' % i, meta + '++++\nHi')
+            site.update_page('content/posts/p%02d.md' % i)
+        return site
+
+    def test_pages(self, tmpdir):
+        site = self.make_site(tmpdir)
+
+        def reference(path=None, tag=None, limit=None, order=None):
+            items = [site.pagedata[key] for key in sorted(site.pagedata)]
+            if path is not None:
+                items = [page for page in items if page.filepath.startswith(path)]
+            if tag is not None:
+                items = [page for page in items if tag in (page.tags or [])]
+            if order is not None:
+                field = order.lstrip('-')
+                items.sort(key=lambda page: getattr(page, field), reverse=order.startswith('-'))
+            if limit:
+                items = items[:limit]
+            return items
+
+        for path in [None, 'posts/', 'posts/p1', 'nope']:
+            for tag in [None, 't1', 'all', 'nope']:
+                for order in [None, 'date', '-date', 'title', '-title']:
+                    for limit in [None, 0, 1, 3, 100]:
+                        if order is not None and path is None and tag is None:
+                            continue  # Not every page has a date
+                        assert site.pages(path=path, tag=tag, order=order, limit=limit) == \
+                            reference(path=path, tag=tag, order=order, limit=limit)
+
+    def test_tag_index(self, tmpdir):
+        site = self.make_site(tmpdir)
+        index = site.get_index()
+        index.ordered('title')
+
+        class Unwalkable(list):
+            def __iter__(self):
+                raise AssertionError('walked every page')
+        index.paths = Unwalkable(index.paths)
+        assert [page.filepath for page in site.pages(tag='t1')] == ['posts/p%02d.md' % i for i in range(1, 20, 3)]
+        assert len(site.pages(tag='t1', order='title', limit=2)) == 2
+
+    def test_missing_field(self, tmpdir):
+        site = self.make_site(tmpdir)
+        pages = site.pages(order="date")
+        assert pages[-1].date is None
+        assert pages[0].date == '2016-01-01'
+        pages = site.pages(order="-date")
+        assert pages[-1].date is None
+        assert pages[0].date == '2016-04-02'
+
+    def test_mixed_dates(self, tmpdir):
+        site = self.make_site(tmpdir)
+        for name, date in [('a', 'March 3, 2016'), ('b', '2016-01-01T12:00:00+02:00'), ('c', '2016/02/01')]:
+            site.cache.set('content/mixed/%s.md' % name, 'title = %s\ndate = %s\n++++\nHi' % (name, date))
+            site.update_page('content/mixed/%s.md' % name)
+        assert [page.title for page in site.pages(path='mixed/', order='date')] == ['b', 'c', 'a']
+        assert [page.title for page in site.pages(path='mixed/', order='-date')] == ['a', 'c', 'b']
+        assert site.pagedata['mixed/b.md'].date == '2016-01-01T12:00:00+02:00'
+
+    def test_tags(self, tmpdir):
+        site = self.make_site(tmpdir)
+        assert site.tags() == ['all', 'hello', 't0', 't1', 't2']
+
+    def test_memoized(self, tmpdir):
+        site = self.make_site(tmpdir)
+        first = site.pages(path='posts/', order='-date', limit=3)
+        assert site.pages(path='posts/', order='-date', limit=3) == first
+        site.cache.set('content/posts/new.md', 'title = New\ndate = 2017-01-01\n++++\nHi')
+        site.update_page('content/posts/new.md')
+        assert site.pages(path='posts/', order='-date', limit=3)[0].title == 'New'
+
+
+class TestFeeds:
+    def test_atom(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.cache.set('content/articles/cake.md', 'title = Cake & "pie"\ndate = 2016-05-01\n++++\n<b>Yum</b>')
+        site.update_page('content/articles/cake.md')
+        feed = site.atom(feed_title="My Site", feed_url="https://example.com/atom.xml", feed_subtitle=None,
+                         site_url="https://example.com", author="me", path="articles/", order="-date")
+        assert feed.startswith('<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">')
+        assert '<updated>2016-05-01T00:00:00Z</updated>' in feed
+        assert '<title type="text">Cake &amp; &quot;pie&quot;</title>' in feed
+        assert '<content type="html">&lt;p&gt;&lt;b&gt;Yum&lt;/b&gt;&lt;/p&gt;</content>' in feed
+        assert feed.index('/articles/cake/') < feed.index('/articles/hello-world/')
+        assert feed.endswith('</entry>\n</feed>\n')
+
+    def test_atom_limit(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.cache.set('content/articles/cake.md', 'title = Cake\ndate = 2016-05-01\n++++\nYum')
+        site.update_page('content/articles/cake.md')
+        feed = site.atom("My Site", None, None, "https://example.com", "me", path="articles/", order="-date", limit=1)
+        assert feed.count('<entry>') == 1
+        assert '/articles/cake/' in feed
+
+    def test_atom_memoized(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        first = site.atom("My Site", None, None, "https://example.com", "me", path="articles/")
+        monkeypatch.setattr(cli.AtomFeed, 'generate', None)
+        assert site.atom("My Site", None, None, "https://example.com", "me", path="articles/") == first
+
+
 class TestUpdates:
     def test_list_dependents(self, tmpdir):
         site = cli.Site.initialize(tmpdir.strpath)
@@ -271,6 +974,30 @@ class TestUpdates:
             'tags.html',
         ]
 
+    def test_list_dependents_custom_template(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.cache.set('layouts/wide.html', '{% extends "markdown.html" %}')
+        site.cache.set('layouts/sidebar.html', '{% import "macros.html" as m %}')
+        site.update_template('wide.html')
+        site.update_template('sidebar.html')
+        site.cache.set('content/articles/wide.md', 'title = Wide\ntemplate = wide.html\n++++\nHi')
+        site.cache.set('content/side.html', '{% include "sidebar.html" %}')
+        site.update_page('content/articles/wide.md')
+        site.update_page('content/side.html')
+
+        # Markdown pages with a custom template are found through it
+        assert site.list_dependents('wide.html') == ['articles/wide.md']
+        assert site.list_dependents('markdown.html') == ['articles/hello-world.md', 'articles/wide.md']
+        assert 'articles/wide.md' in site.list_dependents('basic.html')
+
+        # Include and import chains are followed too
+        assert site.list_dependents('macros.html') == ['side.html']
+
+        # Changing a template updates the graph
+        site.cache.set('layouts/wide.html', '{% extends "basic.html" %}')
+        site.update_template('wide.html')
+        assert site.list_dependents('markdown.html') == ['articles/hello-world.md']
+
     def test_render_dependents(self, tmpdir):
         site = cli.Site.initialize(tmpdir.strpath)
         site.render_dependents('markdown.html')
@@ -278,9 +1005,374 @@ class TestUpdates:
         assert 'output/articles/hello-world/index.html' in files
 
 
+    def test_apply_changes(self, tmpdir, monkeypatch):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        rendered = []
+        render = cli.Page.render
+
+        def counting_render(page):
+            rendered.append(page.filepath)
+            return render(page)
+        monkeypatch.setattr(cli.Page, 'render', counting_render)
+
+        # A burst of changes renders each affected page once
+        with open(join(site.root, 'layouts', 'basic.html'), 'a') as f:
+            f.write('<!-- changed -->')
+        with open(join(site.root, 'content', 'articles', 'hello-world.md'), 'a') as f:
+            f.write('More words')
+        site.apply_changes(['layouts/basic.html', 'content/articles/hello-world.md', 'layouts/basic.html'])
+        assert sorted(rendered) == ['articles.html', 'articles/hello-world.md', 'atom.xml', 'index.html', 'tags.html']
+        assert 'More words' in open(join(site.root, 'output', 'articles', 'hello-world', 'index.html')).read()
+
+        # Pages that list other pages pick up a new title
+        del rendered[:]
+        article = join(site.root, 'content', 'articles', 'hello-world.md')
+        with open(article) as f:
+            source = f.read()
+        with open(article, 'w') as f:
+            f.write(source.replace('title = ', 'title = Retitled ', 1))
+        site.apply_changes(['content/articles/hello-world.md'])
+        assert sorted(rendered) == ['articles.html', 'articles/hello-world.md', 'atom.xml', 'index.html', 'tags.html']
+        for listing in [['articles', 'index.html'], ['index.html'], ['atom.xml']]:
+            assert 'Retitled' in open(join(site.root, 'output', *listing)).read()
+
+        # Nothing changed, so nothing is rendered
+        del rendered[:]
+        site.apply_changes(['layouts/basic.html'])
+        assert rendered == []
+
+        # Deleting files removes their output instead of the source folder
+        os.remove(join(site.root, 'content', 'articles', 'hello-world.md'))
+        os.remove(join(site.root, 'static', 'css', 'main.css'))
+        site.apply_changes(['content/articles', 'static/css/main.css'])
+        assert 'articles/hello-world.md' not in site.pagedata
+        assert site.cache.get('content/articles/hello-world.md') is None
+        assert not exists(join(site.root, 'output', 'articles', 'hello-world', 'index.html'))
+        assert not exists(join(site.root, 'output', 'css', 'main.css'))
+        assert isdir(join(site.root, 'content', 'articles'))
+
+    def test_apply_changes_memory(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        site = cli.Site(site.root, preview_mode=True, store=cli.OutputStore(), write_output=False)
+        site.fill_store()
+        os.remove(join(site.root, 'static', 'css', 'main.css'))
+        site.apply_changes(['static/css/main.css'])
+        assert site.store.get('/css/main.css') is None
+
+        # The build on disk is left alone
+        assert isfile(join(site.root, 'output', 'css', 'main.css'))
+
+    def test_change_queue(self):
+        queue = cli.ChangeQueue(window=0.01)
+        for path in ['content/b.html', 'content/a.html', 'content/b.html']:
+            queue.add(path)
+        assert queue.get() == ['content/a.html', 'content/b.html']
+        queue.add('content/c.html')
+        assert queue.get() == ['content/c.html']
+
+    def test_handler(self, tmpdir):
+        import watchdog.events
+        site = cli.Site.initialize(tmpdir.strpath)
+        cli.Watcher(site)
+        handler = cli.Handler()
+        handler.dispatch(watchdog.events.FileModifiedEvent(join(site.root, 'output', 'index.html')))
+        handler.dispatch(watchdog.events.DirModifiedEvent(join(site.root, 'content')))
+        handler.dispatch(watchdog.events.FileMovedEvent(join(site.root, 'content', '.index.html.swp'),
+                                                        join(site.root, 'content', 'index.html')))
+        # Swap files are ignored
+        assert handler.queue.get() == [join('content', 'index.html')]
+
+    def test_watch(self, tmpdir):
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        observer = cli.Watcher(site, window=0.01).start()
+        try:
+            with open(join(site.root, 'content', 'index.html'), 'w') as f:
+                f.write('Hello from the watcher')
+            output = join(site.root, 'output', 'index.html')
+            for _ in range(100):
+                if 'Hello from the watcher' in open(output).read():
+                    break
+                time.sleep(0.05)
+            assert open(output).read() == 'Hello from the watcher'
+        finally:
+            observer.stop()
+            observer.join()
+
+
+class TestBench:
+    def test_generate_site(self, tmpdir):
+        from icecake import bench
+        root = join(tmpdir.strpath, 'site')
+        bench.generate_site(root, pages=5, tags=2, layout_depth=3, code_blocks=2, static_files=2, static_size=10)
+        site = cli.Site(root)
+        assert len(site.pages(path='articles/')) == 6
+        assert set(site.tags()) - set(['tag-0', 'tag-1']) == set(['hello'])
+        assert site.pagedata['articles/post-00000.md'].get_template_name() == 'bench-3.html'
+        assert 'post-00000.md' in ' '.join(site.list_dependents('bench-1.html'))
+        assert os.path.getsize(join(root, 'static', 'assets', 'asset-0001.bin')) == 10
+        import random
+        rand = random.Random(0)
+        assert [len(bench.random_bytes(rand, size)) for size in [0, 1, 4096]] == [0, 1, 4096]
+
+    def test_front_matter(self, tmpdir):
+        from icecake import bench
+        root = join(tmpdir.strpath, 'site')
+        bench.generate_site(root, pages=5, static_files=0)
+        sources = bench.Benchmark(root).front_matter_sources()
+        assert len(sources) == 6
+        for source in sources:
+            assert bench.parse_with_configparser(source) == cli.parse_front_matter(source)
+
+    def test_run(self, tmpdir):
+        from icecake import bench
+        report = bench.run(root=join(tmpdir.strpath, 'site'), repeat=1, pages=3, static_files=1)
+        assert sorted(report['results']) == sorted(bench.Benchmark.steps)
+        assert report['params']['pages'] == 3
+        assert all(len(result['runs']) == 1 for result in report['results'].values())
+
+        baseline = {'results': dict((step, {'median': result['median'] / 2})
+                                    for step, result in report['results'].items())}
+        comparison = bench.compare(report, baseline)
+        assert [row[0] for row in comparison] == bench.Benchmark.steps
+        assert all(row[4] for row in comparison if row[1])
+        assert not any(row[4] for row in bench.compare(report, report))
+
+
+class TestServer:
+    def start(self, site, events=None):
+        """
+        Run the preview server on a random port in a background thread
+        """
+        if sys.version_info < (3, 7):
+            pytest.skip("The preview server requires Python 3.7")
+        import asyncio
+        import threading
+        from icecake.server import AsyncServer
+
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(AsyncServer(site, events).start('127.0.0.1', 0))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+        return server.sockets[0].getsockname()[1], stop
+
+    def test_keep_alive(self, tmpdir):
+        from http.client import HTTPConnection
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.build()
+        port, stop = self.start(site)
+        try:
+            conn = HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            assert response.status == 200
+            assert response.getheader('Content-Type') == 'text/html; charset=utf-8'
+            assert response.read() == open(join(site.root, 'output', 'index.html'), 'rb').read()
+            sock = conn.sock
+
+            conn.request('HEAD', '/css/main.css')
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 200
+            assert response.getheader('Content-Type') == 'text/css; charset=utf-8'
+            assert response.getheader('Last-Modified') is not None
+
+            conn.request('GET', '/articles')
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 301
+            assert response.getheader('Location') == '/articles/'
+
+            conn.request('GET', '/nope/')
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 404
+
+            conn.request('GET', '/../../etc/passwd')
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 404
+
+            # All of these went over the same connection
+            assert conn.sock is sock
+            conn.close()
+        finally:
+            stop()
+
+    def test_precompressed(self, tmpdir):
+        import gzip
+        from http.client import HTTPConnection
+        site = cli.Site.initialize(tmpdir.strpath)
+        site.precompressor.threshold = 0
+        site.build(compress=True)
+        index = open(join(site.root, 'output', 'index.html'), 'rb').read()
+        port, stop = self.start(site)
+        try:
+            conn = HTTPConnection('127.0.0.1', port)
+            conn.request('GET', '/', headers={'Accept-Encoding': 'gzip, deflate'})
+            response = conn.getresponse()
+            assert response.getheader('Content-Encoding') == 'gzip'
+            assert response.getheader('Content-Type') == 'text/html; charset=utf-8'
+            assert response.getheader('Vary') == 'Accept-Encoding'
+            assert gzip.decompress(response.read()) == index
+
+            for accept in [None, 'gzip;q=0', 'identity']:
+                conn.request('GET', '/', headers={'Accept-Encoding': accept} if accept else {})
+                response = conn.getresponse()
+                assert response.getheader('Content-Encoding') is None
+                assert response.read() == index
+
+            # Compressed files older than the original are stale
+            os.utime(join(site.root, 'output', 'index.html.gz'), (1, 1))
+            conn.request('GET', '/', headers={'Accept-Encoding': 'gzip'})
+            response = conn.getresponse()
+            assert response.getheader('Content-Encoding') is None
+            assert response.read() == index
+            conn.close()
+        finally:
+            stop()
+
+    def test_events(self, tmpdir):
+        from http.client import HTTPConnection
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+        site = cli.Site.initialize(tmpdir.strpath)
+        events = Queue()
+        site.listeners.append(events.put)
+        port, stop = self.start(site, events)
+        try:
+            conn = HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/__icecake/events')
+            response = conn.getresponse()
+            assert response.status == 200
+            assert response.getheader('Content-Type') == 'text/event-stream'
+            assert response.fp.readline() == b'event: hello\n'
+            assert response.fp.readline() == b'data: {"live": true}\n'
+            assert response.fp.readline() == b'\n'
+
+            # Editing a page publishes its URL to the browser
+            site.update_page(join('content', 'index.html')).render_to_disk()
+            site.copy_static('css/main.css')
+            site.publish()
+            assert response.fp.readline() == b'event: change\n'
+            assert response.fp.readline() == b'data: ["/", "/css/main.css"]\n'
+            conn.close()
+        finally:
+            stop()
+
+    def test_store(self, tmpdir):
+        from http.client import HTTPConnection
+        cli.Site.initialize(tmpdir.strpath)
+        site = cli.Site(tmpdir.strpath, preview_mode=True, store=cli.OutputStore(), write_output=False)
+        site.fill_store()
+        port, stop = self.start(site)
+        try:
+            conn = HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            assert response.status == 200
+            assert response.read() == site.pagedata['index.html'].rendered.encode('utf-8')
+            etag = response.getheader('ETag')
+
+            conn.request('GET', '/', headers={'If-None-Match': etag})
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 304
+
+            conn.request('GET', '/css/main.css')
+            response = conn.getresponse()
+            assert response.read() == open(join(site.root, 'static', 'css', 'main.css'), 'rb').read()
+
+            conn.request('GET', '/articles/hello-world')
+            response = conn.getresponse()
+            response.read()
+            assert response.status == 301
+
+            # Changes are served without touching the output folder
+            with open(join(site.root, 'content', 'index.html'), 'w') as f:
+                f.write('Fresh from memory')
+            site.cache.read(join('content', 'index.html'))
+            site.update_page(join('content', 'index.html')).render_to_disk()
+            conn.request('GET', '/index.html')
+            response = conn.getresponse()
+            assert b'Fresh from memory' in response.read()
+            conn.close()
+        finally:
+            stop()
+        assert not exists(join(site.root, 'output'))
+
+    def test_store_get(self):
+        store = cli.OutputStore()
+        store.put(join('articles', 'hello', 'index.html'), 'hello')
+        store.put_file(join('css', 'main.css'), '/site/static/css/main.css')
+        assert store.get('/articles/hello/').body == b'hello'
+        assert store.get('/articles/hello/index.html?x=1').body == b'hello'
+        assert store.get('/articles/../articles/hello/').body == b'hello'
+        assert store.get('/articles/hello') is None
+        assert store.get('/css/main.css').source == '/site/static/css/main.css'
+        store.remove(join('css', 'main.css'))
+        assert store.get('/css/main.css') is None
+
+    def test_output_url(self):
+        assert cli.output_url('index.html') == '/'
+        assert cli.output_url(join('articles', 'hello', 'index.html')) == '/articles/hello/'
+        assert cli.output_url(join('css', 'main.css')) == '/css/main.css'
+
+    def test_translate_path(self):
+        assert cli.translate_path('/site', '/a/b/?x=1') == '/site/output/a/b/'
+        assert cli.translate_path('/site', '/a/%20b.css#top') == '/site/output/a/ b.css'
+        assert cli.translate_path('/site', '/../../etc/passwd') == '/site/output/etc/passwd'
+
+
 class TestCLI:
     # TODO add tests for the CLI
-    pass
+
+    # Modules that only some commands need. Importing the CLI must not load
+    # these, since we run from git hooks and editors many times a day.
+    heavy_modules = ['markdown', 'pygments', 'dateutil', 'watchdog', 'multiprocessing',
+                     'werkzeug', 'http.server', 'xml.sax', 'jinja2.meta']
+
+    # Budget for importing icecake.cli, in microseconds
+    import_budget = 250000
+
+    def run_python(self, *args):
+        import subprocess
+        env = dict(os.environ, PYTHONPATH=module_root)
+        process = subprocess.Popen((sys.executable,) + args, env=env, cwd=module_root,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        assert process.returncode == 0, stderr
+        return stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    def test_lazy_imports(self):
+        stdout, _ = self.run_python('-c', 'import sys, icecake.cli; print(" ".join(sys.modules))')
+        loaded = stdout.split()
+        assert [module for module in self.heavy_modules if module in loaded] == []
+
+    def test_import_time(self):
+        if sys.version_info < (3, 7):
+            pytest.skip("-X importtime requires Python 3.7")
+        timings = []
+        for _ in range(3):
+            _, stderr = self.run_python('-X', 'importtime', '-c', 'import icecake.cli')
+            for line in stderr.splitlines():
+                fields = [field.strip() for field in line.split('|')]
+                if fields[-1] == 'icecake.cli':
+                    timings.append(int(fields[1]))
+        # Take the best run so a busy machine doesn't fail the test
+        assert min(timings) < self.import_budget
 
 
 class TestTemplates: